@@ -0,0 +1,86 @@
+# Addresses - bulk provisioning of agent addresses
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+import base58
+import numpy as np
+
+# Mainnet prefix of a wallet import format key, as used by bitcoinaddress
+_wif_prefix = b'\x80'
+# Keys generated by each worker task
+_chunk = 50000
+
+
+def private_key(seed, index):
+    """ Private key of agent index in the pool of seed.
+
+    Args:
+        seed (int): seed of the address pool
+        index (int): position of the agent in the pool
+    """
+    return sha256('{}:{}'.format(seed, index).encode()).digest()
+
+
+def wif(key):
+    """ Wallet import format of a private key, the same string
+    bitcoinaddress.Wallet gives in key.mainnet.wif.
+    """
+    payload = _wif_prefix + key
+    checksum = sha256(sha256(payload).digest()).digest()[:4]
+    return base58.b58encode(payload + checksum).decode()
+
+
+def _generate(seed, start, stop):
+    return [wif(private_key(seed, index)) for index in range(start, stop)]
+
+
+def generate_addresses(seed, start, stop, workers=None):
+    """ Addresses start to stop of the pool of seed, generated in parallel.
+
+    Args:
+        seed (int): seed of the address pool
+        start (int): first position to generate
+        stop (int): position after the last one to generate
+        workers (int): number of processes, one per core if None
+    """
+    chunks = [(seed, begin, min(begin + _chunk, stop)) for begin in range(start, stop, _chunk)]
+    if workers == 1 or len(chunks) <= 1:
+        return [address for chunk in chunks for address in _generate(*chunk)]
+    addresses = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for part in executor.map(_generate, *zip(*chunks)):
+            addresses.extend(part)
+    return addresses
+
+
+def provision_addresses(num_agents, seed=0, workers=None, pool_dir=None):
+    """ Addresses of num_agents agents from a deterministic, seed indexed pool.
+
+    Agent i always gets the address derived from (seed, i). With a pool
+    directory the pool is kept on disk, so later runs with the same seed
+    load it and only generate the agents it does not hold yet.
+
+    Args:
+        num_agents (int): number of addresses needed
+        seed (int): seed of the address pool
+        workers (int): number of processes generating keys
+        pool_dir (str): directory of the stored pools, nothing stored if None
+
+    Returns:
+        addresses (list): address of every agent
+    """
+    if pool_dir is None:
+        return generate_addresses(seed, 0, num_agents, workers)
+
+    os.makedirs(pool_dir, exist_ok=True)
+    path = os.path.join(pool_dir, 'addresses_{}.npy'.format(seed))
+    pool = np.load(path, mmap_mode='r') if os.path.exists(path) else np.empty(0, dtype='S51')
+    if len(pool) < num_agents:
+        missing = generate_addresses(seed, len(pool), num_agents, workers)
+        pool = np.concatenate([pool, np.array(missing, dtype='S51')])
+        # Write aside and swap, the old pool may still be memory mapped
+        np.save(path + '.tmp.npy', pool)
+        os.replace(path + '.tmp.npy', path)
+    return [address.decode() for address in pool[:num_agents]]
@@ -0,0 +1,112 @@
+# Benchmark - per-stage timing of the whole simulation workflow
+
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from main import exec
+from timing import StageTimer
+
+# Columns of every benchmark result
+columns = ['dlt', 'agents', 'steps', 'seed', 'step', 'stage', 'seconds']
+# Configuration values used when the config does not give them
+defaults = {'dlt': ['blockchain'], 'agents': [10], 'steps': [10], 'seeds': [0], 'warmup': 1,
+            'options': {}}
+
+
+def load_config(path):
+    """ Read a benchmark configuration, a JSON object like
+    {"dlt": ["blockchain"], "agents": [10, 100], "steps": [24], "seeds": [0, 1],
+     "warmup": 1, "options": {"solver": "dc"}}
+
+    options are passed to exec as keyword arguments.
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+    return dict(defaults, **config)
+
+
+def run_benchmark(config):
+    """ Time every stage of exec over the sweep of the config.
+
+    The sweep is dlt x agents x steps x seeds. Every (dlt, agents, steps)
+    case is run warmup times untimed first, so imports, caches and process
+    pools do not count in the first timed run.
+
+    Args:
+        config (dict): sweep, see load_config
+
+    Returns:
+        results (pd.DataFrame): one row per stage run, with the benchmark columns.
+            step is -1 for the stages done once per run.
+    """
+    config = dict(defaults, **config)
+    frames = []
+    for dlt in config['dlt']:
+        for agents in config['agents']:
+            for steps in config['steps']:
+                for _ in range(config['warmup']):
+                    exec(dlt, agents, steps, seed=config['seeds'][0], **config['options'])
+                for seed in config['seeds']:
+                    timer = StageTimer()
+                    exec(dlt, agents, steps, seed=seed, timer=timer, **config['options'])
+                    frame = pd.DataFrame(timer.records, columns=['step', 'stage', 'seconds'])
+                    frame['step'] = frame['step'].fillna(-1).astype(int)
+                    frame['dlt'], frame['agents'], frame['steps'], frame['seed'] = dlt, agents, steps, seed
+                    frames.append(frame[columns])
+    return pd.concat(frames, ignore_index=True)
+
+
+def summarize(results):
+    """ Median time of every stage per run of each case, over seeds and steps. """
+    per_run = results.groupby(['dlt', 'agents', 'steps', 'seed', 'stage'], as_index=False)['seconds'].sum()
+    per_run['seconds'] /= np.where(per_run['stage'].isin(_per_step_stages(results)), per_run['steps'], 1)
+    return per_run.groupby(['dlt', 'agents', 'steps', 'stage'])['seconds'].median()
+
+
+def _per_step_stages(results):
+    return results.loc[results['step'] >= 0, 'stage'].unique()
+
+
+def compare(results, baseline, threshold=0.1):
+    """ Compare the stage medians of results against a baseline run.
+
+    Args:
+        results (pd.DataFrame): benchmark results
+        baseline (pd.DataFrame): benchmark results of the reference version
+        threshold (float): relative slow-down flagged as a regression
+
+    Returns:
+        comparison (pd.DataFrame): seconds, baseline seconds, their ratio and
+            the regression flag of every stage present in both
+    """
+    comparison = pd.concat([summarize(results).rename('seconds'),
+                            summarize(baseline).rename('baseline')], axis=1, join='inner')
+    comparison['ratio'] = comparison['seconds'] / comparison['baseline']
+    comparison['regression'] = comparison['ratio'] > 1 + threshold
+    return comparison.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="JSON file with the benchmark sweep",
+                        type=str)
+    parser.add_argument("--output", help="CSV file receiving the results",
+                        type=str, default='benchmark_results.csv')
+    parser.add_argument("--baseline", help="CSV results to compare against",
+                        type=str, default=None)
+    parser.add_argument("--threshold", help="Relative slow-down flagged as a regression",
+                        type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = run_benchmark(load_config(args.config))
+    results.to_csv(args.output, index=False)
+    print(summarize(results))
+    if args.baseline:
+        comparison = compare(results, pd.read_csv(args.baseline), args.threshold)
+        print(comparison)
+        if comparison['regression'].any():
+            raise SystemExit("Regression in stages: {}".format(
+                ', '.join(comparison.loc[comparison['regression'], 'stage'].unique())))
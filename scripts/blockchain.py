@@ -1,5 +1,6 @@
 # Blockchain - Agent class definition
 
+import heapq
 import json
 import numpy as np
 import pandas as pd
@@ -7,39 +8,177 @@ import time
 from hashlib import sha256
 from bitcoinaddress import Wallet
 
+from transactions import TransactionStore
+from mempool import Mempool
+import timing
+from timing import null_timer
+from consensus import ProofOfWork, proof_of_work
+
+def _transaction_hash(transaction):
+    return sha256(json.dumps(transaction, sort_keys=True).encode()).digest()
+
+
+def _merkle_levels(transactions):
+    """ All levels of the Merkle tree, from the leaves up to the root. """
+    level = [_transaction_hash(tx) for tx in transactions]
+    levels = [level]
+    while len(level) > 1:
+        if len(level) % 2:
+            # Odd levels pair the last node with itself
+            level = level + [level[-1]]
+        level = [sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(transactions):
+    """ Merkle root of a list of transactions.
+
+    Args:
+        transactions (list): transactions of a block
+
+    Returns:
+        root (str): hex digest of the root, the hash of nothing if no transactions
+    """
+    if not transactions:
+        return sha256(b'').hexdigest()
+    return _merkle_levels(transactions)[-1][0].hex()
+
+
+def merkle_proof(transactions, index):
+    """ Inclusion proof of a single transaction.
+
+    Args:
+        transactions (list): transactions of a block
+        index (int): position of the transaction in the block
+
+    Returns:
+        proof (list): (sibling hash, sibling is on the left) pairs from the
+            leaf up to the root
+    """
+    proof = []
+    for level in _merkle_levels(transactions)[:-1]:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        sibling = index + 1 if index % 2 == 0 else index - 1
+        proof.append((level[sibling].hex(), sibling < index))
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(transaction, proof, root):
+    """ Check that a transaction is included under a Merkle root.
+
+    Args:
+        transaction (dict): transaction to check
+        proof (list): proof built by merkle_proof
+        root (str): Merkle root of the block
+    """
+    node = _transaction_hash(transaction)
+    for sibling, is_left in proof:
+        sibling = bytes.fromhex(sibling)
+        node = sha256(sibling + node).digest() if is_left else sha256(node + sibling).digest()
+    return node.hex() == root
+
+
 class Block:
+    __slots__ = ('index', 'transactions', 'timestamp', 'previous_hash', 'nonce',
+                 'merkle_root', 'seal', 'hash')
 
-    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0):
+    def __init__(self, index, transactions, timestamp, previous_hash, nonce=0, root=None, seal=None):
         """ Initialize agent instance.
 
         Args:
             index (int): corresponding index of the block
-            transactions (list): list of transactions of the corresponding block
+            transactions (TransactionStore): transactions of the corresponding
+                block, a list of transaction dicts is converted. None for a
+                header only block.
             timestamp (): timestamp of the block
             previous_hash (): hash of the previous block
             nonce (): arbitraty number
+            root (str): Merkle root of a header only block
+            seal (dict): signature of the block under proof of authority
         """
+        if transactions is not None and not isinstance(transactions, TransactionStore):
+            transactions = TransactionStore.from_dicts(transactions)
         self.index = index
         self.transactions = transactions
         self.timestamp = timestamp
         self.previous_hash = previous_hash
         self.nonce = nonce
+        self.seal = seal
+        # Computed once, the header commits to the transactions through it
+        self.merkle_root = merkle_root(transactions) if transactions is not None else root
+
+    def header_prefix(self):
+        """
+        Encoded header fields preceding the nonce.
+        """
+        return "{}:{}:{!r}:{}:".format(self.index, self.previous_hash,
+                                       self.timestamp, self.merkle_root).encode()
 
     def compute_hash(self):
         """
-        A function that return the hash of the block contents.
+        A function that return the hash of the block header.
+        """
+        return sha256(self.header_prefix() + str(self.nonce).encode()).hexdigest()
+
+    def has_valid_root(self):
+        """
+        Check that the transactions still hash to the Merkle root of the
+        header. Header only blocks have nothing to check.
         """
-        block_string = json.dumps(self.__dict__, sort_keys=True)
-        return sha256(block_string.encode()).hexdigest()
+        return self.transactions is None or merkle_root(self.transactions) == self.merkle_root
+
+    def transaction_proof(self, index):
+        """
+        Merkle inclusion proof of the transaction at index.
+        """
+        return merkle_proof(self.transactions, index)
+
+    def to_dict(self):
+        """
+        Block fields as stored in chain dumps.
+        """
+        block_data = {'index': self.index,
+                      'transactions': self.transactions.to_list() if self.transactions is not None else None,
+                      'timestamp': self.timestamp,
+                      'previous_hash': self.previous_hash,
+                      'nonce': self.nonce,
+                      'merkle_root': self.merkle_root}
+        if self.seal is not None:
+            block_data['seal'] = self.seal
+        if hasattr(self, 'hash'):
+            block_data['hash'] = self.hash
+        return block_data
 
 
 class Blockchain:
     # difficulty of our PoW algorithm
     difficulty = 2
 
-    def __init__(self):
-        self.unconfirmed_transactions = []
+    def __init__(self, mining_workers=1, store=None, consensus=None, mempool=None):
+        """ Initialize blockchain instance.
+
+        Args:
+            mining_workers (int): processes searching the nonce in proof_of_work
+            store (ChainStore): on-disk store receiving every added block. The
+                in-memory chain then only keeps block headers.
+            consensus: engine sealing and verifying the blocks, see
+                consensus.py. Proof of work at difficulty if None.
+            mempool (Mempool): pending transactions and block size limits,
+                an unbounded pool mined into one block if None
+        """
+        self.unconfirmed_transactions = Mempool() if mempool is None else mempool
         self.chain = []
+        self.mining_workers = mining_workers
+        if consensus is None:
+            consensus = ProofOfWork(self.difficulty, mining_workers)
+        self.consensus = consensus
+        self.store = store
+        # (chain, height, tip hash) of the last chain of each peer that
+        # passed validation, None holds the chain checked without a peer
+        self._checkpoints = {}
 
     def create_genesis_block(self):
         """
@@ -49,7 +188,28 @@ class Blockchain:
         """
         genesis_block = Block(0, [], 0, "0")
         genesis_block.hash = genesis_block.compute_hash()
-        self.chain.append(genesis_block)
+        self._append(genesis_block)
+
+    def load_headers(self):
+        """
+        Rebuild the in-memory chain from the headers of the store,
+        streaming through it without reading transactions.
+        """
+        self.chain = []
+        for height in range(len(self.store)):
+            header = self.store.header(height)
+            block = Block(header['index'], None, header['timestamp'],
+                          header['previous_hash'], header['nonce'],
+                          header['merkle_root'], header.get('seal'))
+            block.hash = header['hash']
+            self.chain.append(block)
+
+    def _append(self, block):
+        self.chain.append(block)
+        if self.store is not None:
+            self.store.append(block)
+            # Transactions stay on disk, the header is enough for the chain
+            block.transactions = None
 
     @property
     def last_block(self):
@@ -62,36 +222,30 @@ class Blockchain:
         * Checking if the proof is valid.
         * The previous_hash referred in the block and the hash of latest block
           in the chain match.
+        The Merkle root is not recomputed, blocks reaching this point were
+        just built from their transactions, by mine() or from a block dict.
         """
         previous_hash = self.last_block.hash
 
         if previous_hash != block.previous_hash:
             return False
 
-        if not Blockchain.is_valid_proof(block, proof):
+        if not self.consensus.verify(block, proof):
             return False
 
         block.hash = proof
-        self.chain.append(block)
+        self._append(block)
         return True
 
     @staticmethod
-    def proof_of_work(block):
+    def proof_of_work(block, workers=1):
         """
-        Function that tries different values of nonce to get a hash
-        that satisfies our difficulty criteria.
+        Proof of work at the class difficulty, see consensus.proof_of_work.
         """
-        block.nonce = 0
-
-        computed_hash = block.compute_hash()
-        while not computed_hash.startswith('0' * Blockchain.difficulty):
-            block.nonce += 1
-            computed_hash = block.compute_hash()
-
-        return computed_hash
+        return proof_of_work(block, Blockchain.difficulty, workers)
 
-    def add_new_transaction(self, transaction):
-        self.unconfirmed_transactions.append(transaction)
+    def add_new_transaction(self, transaction, fee=0.0):
+        return self.unconfirmed_transactions.append_dict(transaction, fee)
 
     @classmethod
     def is_valid_proof(cls, block, block_hash):
@@ -102,98 +256,259 @@ class Blockchain:
         return (block_hash.startswith('0' * Blockchain.difficulty) and
                 block_hash == block.compute_hash())
 
-    @classmethod
-    def check_chain_validity(cls, chain):
-        result = True
-        previous_hash = "0"
-
-        for block in chain:
-            block_hash = block.hash
-            delattr(block, "hash")
+    def check_chain_validity(self, chain, peer=None):
+        """
+        Check the hashes, seals, links and Merkle roots of a chain. The
+        roots are recomputed from the transactions, the cached one of a
+        header does not follow changes to them. The height and tip hash
+        of the last chain of each peer that passed are kept, so when the
+        same chain object only grew since that check it is verified from
+        the checkpoint on. Blocks are not modified.
 
-            if not cls.is_valid_proof(block, block_hash) or \
-                    previous_hash != block.previous_hash:
-                result = False
-                break
+        The blocks below a checkpoint are not checked again, so a
+        transaction changed in place inside that prefix is only caught by
+        a full check, e.g. after forget_peer.
 
-            block.hash, previous_hash = block_hash, block_hash
+        Args:
+            chain (list): blocks of the chain
+            peer (str): address of the peer holding the chain
+        """
+        start, previous_hash = 0, "0"
+        checkpoint = self._checkpoints.get(peer)
+        if checkpoint is not None:
+            checked_chain, height, tip_hash = checkpoint
+            if checked_chain is chain and height <= len(chain) and \
+                    chain[height - 1].hash == tip_hash and \
+                    chain[height - 1].compute_hash() == tip_hash:
+                start, previous_hash = height, tip_hash
+
+        for block in chain[start:] if start else chain:
+            if block.previous_hash != previous_hash or not block.has_valid_root():
+                return False
+            if block.index == 0:
+                # The genesis block is not mined, its hash only has to match
+                if block.hash != block.compute_hash():
+                    return False
+            elif not self.consensus.verify(block, block.hash):
+                return False
+            previous_hash = block.hash
+
+        if chain:
+            self._checkpoints[peer] = (chain, len(chain), previous_hash)
+        return True
 
-        return result
+    def forget_peer(self, peer):
+        """
+        Drop the validation checkpoint of a peer.
+        """
+        self._checkpoints.pop(peer, None)
 
     def mine(self):
         """
         This function serves as an interface to add the pending
         transactions to the blockchain by adding them to the block
-        and figuring out Proof Of Work.
+        and figuring out Proof Of Work. Blocks are cut from the mempool
+        until it is empty, each one within the block size.
+
+        Returns:
+            blocks (int): number of blocks mined
         """
-        if not self.unconfirmed_transactions:
-            return False
+        blocks = 0
+        while len(self.unconfirmed_transactions):
+            last_block = self.last_block
+            transactions = self.unconfirmed_transactions.pop_block()
+            new_block = Block(index=last_block.index + 1,
+                              transactions=transactions,
+                              timestamp=time.time(),
+                              previous_hash=last_block.hash)
+
+            count = len(transactions)
+            timing.recorder.count('transactions', count)
+            timing.recorder.count('blocks')
+            proof = self.consensus.seal(new_block)
+            self.add_block(new_block, proof)
+            # Submission to inclusion, mean latency is this over transactions
+            timing.recorder.count('latency_seconds',
+                                  float(count * time.time() - transactions.timestamp[:count].sum()))
+            blocks += 1
+
+        return blocks
+
+
+class PeerRegistry:
+    def __init__(self):
+        """ Registered peers and the chain tips they hold.
 
-        last_block = self.last_block
+        Only tips are tracked. A block announced by this node moves every
+        peer to the announced tip at once, and tips reported by single peers
+        go into a max-heap on height, so the longest chain query does not
+        depend on the number of registered peers.
+        """
+        self.addresses = {}
+        self.announced = None
+        self._tips = {}
+        self._heap = []
+        self._count = 0
 
-        new_block = Block(index=last_block.index + 1,
-                          transactions=self.unconfirmed_transactions,
-                          timestamp=time.time(),
-                          previous_hash=last_block.hash)
+    def __len__(self):
+        return len(self.addresses)
 
-        proof = self.proof_of_work(new_block)
-        self.add_block(new_block, proof)
+    def __iter__(self):
+        return iter(self.addresses)
 
-        self.unconfirmed_transactions = []
+    def register(self, address):
+        self.addresses[address] = None
 
-        return True
+    def register_many(self, addresses):
+        self.addresses.update(dict.fromkeys(addresses))
+
+    def announce(self, chain):
+        """ Tip of this node's chain, now held by all peers. """
+        self.announced = (len(chain), chain[-1].hash, chain)
+
+    def update_tip(self, address, chain):
+        """ Tip of the chain held by a single peer. """
+        tip = (len(chain), chain[-1].hash, chain)
+        self._tips[address] = tip
+        self._count += 1
+        heapq.heappush(self._heap, (-tip[0], self._count, address, tip[1]))
+
+    def drop_tip(self, address):
+        self._tips.pop(address, None)
+
+    def longest(self):
+        """ Longest known tip as (height, hash, chain, address).
+
+        The address is None for the announced tip. Heap entries replaced by a
+        later update_tip or dropped are discarded on the way.
+        """
+        while self._heap:
+            height, _, address, tip_hash = self._heap[0]
+            tip = self._tips.get(address)
+            if tip is not None and tip[0] == -height and tip[1] == tip_hash:
+                break
+            heapq.heappop(self._heap)
+
+        best = None
+        if self._heap:
+            address = self._heap[0][2]
+            height, tip_hash, chain = self._tips[address]
+            best = (height, tip_hash, chain, address)
+        if self.announced is not None and (best is None or self.announced[0] >= best[0]):
+            best = self.announced + (None,)
+        return best
 
 
 class Wrapper:
-    def __init__(self):
-        self.blockchain = Blockchain()
-        self.blockchain.create_genesis_block()
-        self.peers = []
+    def __init__(self, mining_workers=1, store=None, consensus=None, mempool=None):
+        self.blockchain = Blockchain(mining_workers, store, consensus, mempool)
+        if store is not None and len(store):
+            self.blockchain.load_headers()
+        else:
+            self.blockchain.create_genesis_block()
+        self.peers = PeerRegistry()
 
-    def new_transaction(self, tx_data):
+    def new_transaction(self, tx_data, fee=0.0):
         required_fields = ['author', 'content']
         for field in required_fields:
             if not tx_data.get(field):
                 return "Invalid transaction data"
+        content_fields = ['payment', 'seller']
+        for field in content_fields:
+            if field not in tx_data['content']:
+                return "Invalid transaction data"
         tx_data['timestamp'] = time.time()
-        self.blockchain.add_new_transaction(tx_data)
+        accepted = self.blockchain.add_new_transaction(tx_data, fee)
+
+        return self._admitted(1, accepted)
+
+    def new_transactions(self, author, payments, sellers, fees=0.0):
+        """ Add the payments of one author in bulk.
+
+        Args:
+            author (str): address of the payer
+            payments (np.ndarray): amount of every payment
+            sellers (list): address of the seller of every payment
+            fees (np.ndarray): fee offered for every payment, or one for all
+        """
+        if not author or len(payments) != len(sellers):
+            return "Invalid transaction data"
+        accepted = self.blockchain.unconfirmed_transactions.extend(author, payments, sellers, time.time(), fees)
+
+        return self._admitted(len(payments), accepted)
+
+    def new_payment_batch(self, authors, sellers, payments, fees=0.0):
+        """ Add the payments of several authors in bulk.
 
+        Args:
+            authors (np.ndarray): address book id of the payer of every payment
+            sellers (np.ndarray): address book id of the seller of every payment
+            payments (np.ndarray): amount of every payment
+            fees (np.ndarray): fee offered for every payment, or one for all
+        """
+        if not len(authors) == len(sellers) == len(payments):
+            return "Invalid transaction data"
+        accepted = self.blockchain.unconfirmed_transactions.extend_ids(authors, sellers, payments, time.time(), fees)
+
+        return self._admitted(len(payments), accepted)
+
+    @staticmethod
+    def _admitted(count, accepted):
+        if accepted < count:
+            timing.recorder.count('dropped', count - accepted)
+            return "Mempool full, {} transactions dropped".format(count - accepted)
         return 'Success'
 
     def get_chain(self):
         chain_data = []
-        for block in self.blockchain.chain:
-            chain_data.append(block.__dict__)
-            return json.dumps({"length": len(chain_data), "chain": chain_data, "peers": list(self.peers)})
-
-    def mine_unconfirmed_transactions(self):
-        result = self.blockchain.mine()
+        if self.blockchain.store is not None:
+            blocks = self.blockchain.store.iter_blocks()
+        else:
+            blocks = self.blockchain.chain
+        for block in blocks:
+            chain_data.append(block.to_dict())
+        return json.dumps({"length": len(chain_data), "chain": chain_data,
+                           "peers": list(self.peers)})
+
+    def mine_unconfirmed_transactions(self, timer=null_timer):
+        with timer.stage('mining'):
+            result = self.blockchain.mine()
         if not result:
             return "No transactions to mine"
         else:
             # Making sure we have the longest chain before announcing to the network
-            chain_length = len(self.blockchain.chain)
-
-            peers = []
-            for peer in self.peers:
-                new_peer = {'address': peer['address'], 'chain': self.blockchain.chain}
-                peers.append(new_peer)
-            self.peers = peers
-
-            self.consensus()
+            with timer.stage('consensus'):
+                self.consensus()
+                self.peers.announce(self.blockchain.chain)
 
-            return "Block #{} is mined.".format(self.blockchain.last_block.index)
+            last = self.blockchain.last_block.index
+            if result > 1:
+                return "Blocks #{} to #{} are mined.".format(last - result + 1, last)
+            return "Block #{} is mined.".format(last)
 
     def register_new_peers(self, node_address):
         if not node_address:
             return "Invalid data"
 
-        peer = {'address': node_address, 'chain': None}
-        self.peers.append(peer)
-        return self.get_chain()
+        self.peers.register(node_address)
+        return 'Success'
+
+    def register_peers(self, node_addresses):
+        """ Register several peers at once. """
+        if not all(node_addresses):
+            return "Invalid data"
+
+        self.peers.register_many(node_addresses)
+        return 'Success'
 
-    def create_chain_from_dump(self, chain_dump):
-        generated_blockchain = Blockchain()
+    def create_chain_from_dump(self, chain_dump, store=None):
+        """
+        Rebuild and verify a chain from block dicts. chain_dump can be
+        any iterable, e.g. ChainStore.iter_dicts, and blocks are handled
+        one at a time. With a store the rebuilt chain is written to it and
+        only headers stay in memory.
+        """
+        generated_blockchain = Blockchain(store=store, consensus=self.blockchain.consensus)
         generated_blockchain.create_genesis_block()
         for idx, block_data in enumerate(chain_dump):
             if idx == 0:
@@ -202,7 +517,8 @@ class Wrapper:
                           block_data["transactions"],
                           block_data["timestamp"],
                           block_data["previous_hash"],
-                          block_data["nonce"])
+                          block_data["nonce"],
+                          seal=block_data.get("seal"))
             proof = block_data['hash']
             added = generated_blockchain.add_block(block, proof)
             if not added:
@@ -214,7 +530,8 @@ class Wrapper:
                       block_data["transactions"],
                       block_data["timestamp"],
                       block_data["previous_hash"],
-                      block_data["nonce"])
+                      block_data["nonce"],
+                      seal=block_data.get("seal"))
 
         proof = block_data['hash']
         added = self.blockchain.add_block(block, proof)
@@ -224,56 +541,41 @@ class Wrapper:
 
         return "Block added to the chain", 201
 
-
-    def create_chain_from_dump(self, chain_dump):
-        generated_blockchain = Blockchain()
-        generated_blockchain.create_genesis_block()
-        for idx, block_data in enumerate(chain_dump):
-            if idx == 0:
-                continue  # skip genesis block
-            block = Block(block_data["index"],
-                          block_data["transactions"],
-                          block_data["timestamp"],
-                          block_data["previous_hash"],
-                          block_data["nonce"])
-            proof = block_data['hash']
-            added = generated_blockchain.add_block(block, proof)
-            if not added:
-                raise Exception("The chain dump is tampered!!")
-        return generated_blockchain
-
-    def get_pending_tx(self):
-        return json.dumps(self.blockchain.unconfirmed_transactions)
+    def get_pending_tx(self, limit=None):
+        """ Pending transactions as JSON, the next limit ones if given. """
+        return json.dumps(self.blockchain.unconfirmed_transactions.peek(limit))
 
 
     def consensus(self):
         """
         Our naive consnsus algorithm. If a longer valid chain is
-        found, our chain is replaced with it.
+        found, our chain is replaced with it. Only the longest tip of
+        the peer registry is checked, invalid ones are dropped.
         """
-        longest_chain = None
-        current_len = len(self.blockchain.chain)
-
-        for node in self.peers:
-            length = len(node['chain'])
-            chain = node['chain']
-            if length > current_len and self.blockchain.check_chain_validity(chain):
-                current_len = length
-                longest_chain = chain
-
-        if longest_chain:
-            blockchain = longest_chain
-            return True
-
-        return False
+        while True:
+            best = self.peers.longest()
+            timing.recorder.count('peers_scanned')
+            if best is None or best[0] <= len(self.blockchain.chain):
+                return False
+            height, tip_hash, chain, address = best
+            if self.blockchain.check_chain_validity(chain, address):
+                self.blockchain.chain = list(chain)
+                return True
+            self.blockchain.forget_peer(address)
+            if address is None:
+                self.peers.announced = None
+            else:
+                self.peers.drop_tip(address)
 
 class Agent:
-    def __init__(self, demand, supply, node, address, price, wrapper):
+    def __init__(self, demand, supply, node, address, price, wrapper, fee_rate=0.0):
         self.demand = demand
         self.supply = supply
         self.node = node
         self.address = address
         self.price = price
+        # Fee offered per unit of payment
+        self.fee_rate = fee_rate
         self.register_peer(wrapper)
 
     def register_peer(self, wrapper):
@@ -317,8 +619,5 @@ class Agent:
             step (float): step running at the moment.
         """
         unpack_data = self.payment_data
-        for index, node in enumerate(unpack_data['node']):
-            tx_data = {'author': self.address,
-                       'content': {'payment': unpack_data['price']*unpack_data['power'][index],
-                                   'seller': unpack_data['seller']}}
-            wrapper.new_transaction(tx_data)
+        payments = unpack_data['price'] * np.asarray(unpack_data['power'])
+        wrapper.new_transactions(self.address, payments, unpack_data['seller'], self.fee_rate * payments)
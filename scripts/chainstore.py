@@ -0,0 +1,194 @@
+# Chain store - append-only on-disk storage of mined blocks
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from blockchain import Block, Blockchain
+from consensus import ProofOfWork
+from transactions import TransactionStore, address_book
+
+# Every record starts with the length of its JSON header
+_header_length = struct.Struct('<I')
+# One (segment, offset, length) entry per block height
+_index_dtype = np.dtype([('segment', '<i8'), ('offset', '<i8'), ('length', '<i8')])
+
+
+class ChainStore:
+    def __init__(self, path, segment_bytes=256 * 2 ** 20):
+        """ Append-only segment files with an offset index by height.
+
+        A record is the JSON block header, with the block's own address
+        table, followed by the transaction columns as raw arrays. Records are
+        read back through memory maps, so block N is found in O(1) from the
+        index and a chain can be streamed without loading it in full.
+
+        Args:
+            path (str): directory of the store, created if missing
+            segment_bytes (int): size after which a new segment file is started
+        """
+        self.path = path
+        self.segment_bytes = segment_bytes
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, 'index.bin')
+        if not os.path.exists(self._index_path):
+            open(self._index_path, 'wb').close()
+        self._index_file = open(self._index_path, 'ab')
+        self._length = os.path.getsize(self._index_path) // _index_dtype.itemsize
+        self._index = None
+        self._maps = {}
+
+        if self._length:
+            last = self._entry(self._length - 1)
+            self._segment = int(last['segment'])
+            self._offset = int(last['offset'] + last['length'])
+        else:
+            self._segment, self._offset = 0, 0
+        self._segment_file = open(self._segment_path(self._segment), 'ab')
+
+    def __len__(self):
+        return self._length
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment_{:05d}.blk'.format(segment))
+
+    def _entry(self, height):
+        if self._index is None or height >= len(self._index):
+            self._index = np.memmap(self._index_path, dtype=_index_dtype, mode='r',
+                                    shape=(self._length,))
+        return self._index[height]
+
+    def _record(self, height):
+        if not 0 <= height < self._length:
+            raise IndexError("block height out of range")
+        entry = self._entry(height)
+        segment, offset, length = int(entry['segment']), int(entry['offset']), int(entry['length'])
+        segment_map = self._maps.get(segment)
+        if segment_map is None or offset + length > len(segment_map):
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return memoryview(segment_map)[offset:offset + length]
+
+    def append(self, block):
+        """ Write a mined block at the next height.
+
+        Args:
+            block (Block): block with its hash, at height len(store)
+        """
+        if block.index != self._length:
+            raise ValueError("Block #{} does not follow height {}".format(block.index, self._length - 1))
+        transactions = block.transactions
+        local_ids, positions = np.unique(np.concatenate([transactions.author[:len(transactions)],
+                                                         transactions.seller[:len(transactions)]]),
+                                         return_inverse=True)
+        count = len(transactions)
+        header = {'index': block.index,
+                  'timestamp': block.timestamp,
+                  'previous_hash': block.previous_hash,
+                  'nonce': block.nonce,
+                  'merkle_root': block.merkle_root,
+                  'seal': block.seal,
+                  'hash': block.hash,
+                  'count': count,
+                  'addresses': [transactions.book[address_id] for address_id in local_ids]}
+        header = json.dumps(header).encode()
+        record = b''.join([_header_length.pack(len(header)), header,
+                           positions[:count].astype('<i4').tobytes(),
+                           positions[count:].astype('<i4').tobytes(),
+                           transactions.payment[:count].astype('<f8').tobytes(),
+                           transactions.timestamp[:count].astype('<f8').tobytes()])
+
+        if self._offset and self._offset + len(record) > self.segment_bytes:
+            self._segment_file.close()
+            self._segment, self._offset = self._segment + 1, 0
+            self._segment_file = open(self._segment_path(self._segment), 'ab')
+        self._segment_file.write(record)
+        self._segment_file.flush()
+
+        entry = np.array([(self._segment, self._offset, len(record))], dtype=_index_dtype)
+        self._index_file.write(entry.tobytes())
+        self._index_file.flush()
+        self._offset += len(record)
+        self._length += 1
+
+    def header(self, height):
+        """ Header fields of block N, without reading its transactions. """
+        record = self._record(height)
+        size = _header_length.unpack_from(record)[0]
+        return json.loads(bytes(record[_header_length.size:_header_length.size + size]))
+
+    def get(self, height):
+        """ Block N with its transactions.
+
+        Args:
+            height (int): index of the block
+        """
+        record = self._record(height)
+        size = _header_length.unpack_from(record)[0]
+        start = _header_length.size + size
+        header = json.loads(bytes(record[_header_length.size:start]))
+        count = header['count']
+        columns = np.frombuffer(record, dtype=np.uint8, offset=start)
+        author = columns[:4 * count].view('<i4')
+        seller = columns[4 * count:8 * count].view('<i4')
+        payment = columns[8 * count:16 * count].view('<f8')
+        timestamp = columns[16 * count:24 * count].view('<f8')
+
+        transactions = TransactionStore(max(count, 1))
+        global_ids = address_book.intern_many(header['addresses'])
+        transactions.author[:count] = global_ids[author]
+        transactions.seller[:count] = global_ids[seller]
+        transactions.payment[:count] = payment
+        transactions.timestamp[:count] = timestamp
+        transactions.size = count
+
+        block = Block(header['index'], transactions, header['timestamp'],
+                      header['previous_hash'], header['nonce'], seal=header.get('seal'))
+        block.hash = header['hash']
+        return block
+
+    def iter_blocks(self, start=0):
+        for height in range(start, self._length):
+            yield self.get(height)
+
+    def iter_dicts(self, start=0):
+        """ Stream the stored chain in the layout of a chain dump. """
+        for block in self.iter_blocks(start):
+            yield block.to_dict()
+
+    def verify(self, consensus=None):
+        """ Replay the stored chain block by block and check it.
+
+        Only one block is loaded at a time. Rebuilding each block recomputes
+        its Merkle root, so the header hash also covers the stored
+        transactions.
+
+        Args:
+            consensus: engine that sealed the blocks, proof of work at the
+                Blockchain difficulty if None
+        """
+        if consensus is None:
+            consensus = ProofOfWork(Blockchain.difficulty)
+        previous_hash = "0"
+        for block in self.iter_blocks():
+            if block.previous_hash != previous_hash:
+                return False
+            if block.index == 0:
+                if block.hash != block.compute_hash():
+                    return False
+            elif not consensus.verify(block, block.hash):
+                return False
+            previous_hash = block.hash
+        return True
+
+    def close(self):
+        self._segment_file.close()
+        self._index_file.close()
+        self._index = None
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
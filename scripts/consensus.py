@@ -0,0 +1,269 @@
+# Consensus - sealing and verification of blocks
+
+import multiprocessing
+from hashlib import sha256
+
+import base58
+import ecdsa
+
+import timing
+
+
+def proof_of_work(block, difficulty, workers=1):
+    """
+    Function that tries different values of nonce to get a hash
+    that satisfies our difficulty criteria. With more than one worker
+    the nonce space is split in chunks searched by a process pool, and
+    the smallest valid nonce is kept, the same one a single worker finds.
+    The pool only lives for this block, engines keep theirs, see
+    ProofOfWork.
+    """
+    if workers > 1:
+        engine = ProofOfWork(difficulty, workers)
+        try:
+            return engine.seal(block)
+        finally:
+            engine.close()
+
+    prefix = '0' * difficulty
+    header = sha256(block.header_prefix())
+    nonce = 0
+    while True:
+        attempt = header.copy()
+        attempt.update(str(nonce).encode())
+        computed_hash = attempt.hexdigest()
+        if computed_hash.startswith(prefix):
+            break
+        nonce += 1
+
+    timing.recorder.count('hashes', nonce + 1)
+    block.nonce = nonce
+    return computed_hash
+
+
+def search_nonces(header, difficulty, start, stop):
+    """ Search the nonces start to stop of a header, for searches that
+    have to stop between ranges.
+
+    Args:
+        header: sha256 object holding the header prefix of the block
+        difficulty (int): number of leading zero hex digits of a valid hash
+        start (int): first nonce to try
+        stop (int): nonce after the last one to try
+
+    Returns:
+        found (tuple): (nonce, hash) of the first valid nonce, None if there is none
+    """
+    prefix = '0' * difficulty
+    for nonce in range(start, stop):
+        attempt = header.copy()
+        attempt.update(str(nonce).encode())
+        computed_hash = attempt.hexdigest()
+        if computed_hash.startswith(prefix):
+            return nonce, computed_hash
+    return None
+
+
+# Nonces searched by each worker task of the parallel proof of work
+_nonce_chunk = 4096
+
+# Shared state of the proof of work worker processes, set by _init_miner
+_miner_found = None
+_miner_block = None
+
+
+def _init_miner(found, block):
+    global _miner_found, _miner_block
+    _miner_found = found
+    _miner_block = block
+
+
+def _search_nonces(header_prefix, difficulty, block, start):
+    """ Search the nonces of one chunk, stopping once a smaller one is found
+    or the pool has moved on to another block. """
+    prefix = '0' * difficulty
+    header = sha256(header_prefix)
+    for nonce in range(start, start + _nonce_chunk):
+        if nonce % 256 == 0 and (_miner_block.value != block or _miner_found.value < nonce):
+            return None
+        attempt = header.copy()
+        attempt.update(str(nonce).encode())
+        computed_hash = attempt.hexdigest()
+        if computed_hash.startswith(prefix):
+            with _miner_found.get_lock():
+                if _miner_block.value == block and nonce < _miner_found.value:
+                    _miner_found.value = nonce
+            return nonce, computed_hash
+    return None
+
+
+class ProofOfWork:
+    name = 'pow'
+
+    def __init__(self, difficulty=2, workers=1):
+        """ Blocks sealed by a nonce giving a hash with difficulty leading zeros.
+
+        Args:
+            difficulty (int): number of leading zero hex digits of a valid hash
+            workers (int): processes searching the nonce
+        """
+        self.difficulty = difficulty
+        self.workers = workers
+        self._pool = None
+        self._found = None
+        self._block = None
+
+    def __getstate__(self):
+        # Engines are sent to other processes without their pool
+        state = self.__dict__.copy()
+        state.update(_pool=None, _found=None, _block=None)
+        return state
+
+    def seal(self, block):
+        """ Seal a block, setting its nonce.
+
+        Returns:
+            block_hash (str): hash of the sealed block
+        """
+        if self.workers > 1:
+            return self._parallel_seal(block)
+        return proof_of_work(block, self.difficulty)
+
+    def _parallel_seal(self, block):
+        """ Proof of work over the process pool of the engine.
+
+        The pool is started with the first block and kept. Chunks are
+        handed out in nonce order and collected in the same order, so the
+        first chunk reporting a valid hash holds the smallest valid nonce.
+        Workers on later chunks see the shared value and stop, and the ones
+        still searching when the block is sealed see the block counter move
+        on and stop too.
+        """
+        if self._pool is None:
+            self._found = multiprocessing.Value('q', 2 ** 62)
+            self._block = multiprocessing.Value('q', 0)
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_miner,
+                                              initargs=(self._found, self._block))
+        with self._found.get_lock():
+            self._found.value = 2 ** 62
+            self._block.value += 1
+        header_prefix, current = block.header_prefix(), self._block.value
+        pending = []
+        next_start = 0
+        while True:
+            while len(pending) < 2 * self.workers:
+                pending.append(self._pool.apply_async(_search_nonces, (header_prefix, self.difficulty,
+                                                                       current, next_start)))
+                next_start += _nonce_chunk
+            result = pending.pop(0).get()
+            if result is not None:
+                break
+        with self._found.get_lock():
+            self._block.value += 1
+        for task in pending:
+            task.wait()
+
+        # Nonces handed out to the workers, chunks stopped early count in full
+        timing.recorder.count('hashes', next_start)
+        block.nonce, computed_hash = result
+        return computed_hash
+
+    def close(self):
+        """ Stop the process pool of the parallel search. """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def verify(self, block, block_hash):
+        """
+        Check if block_hash is valid hash of block and satisfies
+        the difficulty criteria.
+        """
+        return (block_hash.startswith('0' * self.difficulty) and
+                block_hash == block.compute_hash())
+
+
+def signing_key(wif):
+    """ secp256k1 signing key of a wallet import format private key. """
+    return ecdsa.SigningKey.from_string(base58.b58decode(wif)[1:33], curve=ecdsa.SECP256k1)
+
+
+class ProofOfAuthority:
+    name = 'poa'
+
+    def __init__(self, authorities, signer=None):
+        """ Blocks sealed by the signature of one of a set of authorities.
+
+        The block hash is the plain header hash and the seal holds the
+        public key of the signer with its deterministic ECDSA signature of
+        that hash. No nonce is searched, so sealing costs one signature.
+
+        Args:
+            authorities (list): wallet import format keys of the agents
+                allowed to seal blocks
+            signer (str): key sealing the blocks of this node, the first
+                authority if None
+        """
+        keys = [signing_key(wif) for wif in authorities]
+        self.authorities = {key.get_verifying_key().to_string('compressed').hex(): key.get_verifying_key()
+                            for key in keys}
+        self.signer = keys[0] if signer is None else signing_key(signer)
+        self.public_key = self.signer.get_verifying_key().to_string('compressed').hex()
+        if self.public_key not in self.authorities:
+            raise ValueError("The signer is not one of the authorities")
+
+    def seal(self, block):
+        block_hash = block.compute_hash()
+        signature = self.signer.sign_digest_deterministic(bytes.fromhex(block_hash), hashfunc=sha256)
+        block.seal = {'signer': self.public_key, 'signature': signature.hex()}
+        timing.recorder.count('signatures')
+        return block_hash
+
+    def verify(self, block, block_hash):
+        if block_hash != block.compute_hash() or not block.seal:
+            return False
+        key = self.authorities.get(block.seal.get('signer'))
+        if key is None:
+            return False
+        try:
+            return key.verify_digest(bytes.fromhex(block.seal['signature']), bytes.fromhex(block_hash))
+        except ecdsa.BadSignatureError:
+            return False
+
+
+class NoSeal:
+    name = 'none'
+
+    def seal(self, block):
+        """ Blocks are only hashed, to measure the ledger without consensus cost. """
+        return block.compute_hash()
+
+    def verify(self, block, block_hash):
+        return block_hash == block.compute_hash()
+
+
+# Consensus names accepted by create_consensus
+engines = ('pow', 'poa', 'none')
+
+
+def create_consensus(name, keys=None, authorities=1, difficulty=2, workers=1):
+    """ Consensus engine by name.
+
+    Args:
+        name (str): one of engines
+        keys (list): wallet import format keys of the agents. The first
+            authorities ones seal blocks under proof of authority.
+        authorities (int): number of authorities under proof of authority
+        difficulty (int): difficulty of proof of work
+        workers (int): processes searching the proof of work nonce
+    """
+    if name == 'pow':
+        return ProofOfWork(difficulty, workers)
+    if name == 'poa':
+        if not keys:
+            raise ValueError("Proof of authority needs the keys of the authorities")
+        return ProofOfAuthority(keys[:authorities])
+    if name == 'none':
+        return NoSeal()
+    raise ValueError("Unknown consensus {}, expected one of {}".format(name, engines))
@@ -0,0 +1,246 @@
+# Datasets - demand, supply and price series as memory mapped arrays
+
+import os
+import warnings
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Series of a dataset, each one a <name>.csv or <name>.npy file
+series = ('demand', 'supply', 'price')
+# Agents parsed at a time when converting CSV files
+_chunk_rows = 65536
+# Steps generated at a time by synthesize
+_chunk_steps = 1024
+
+
+class Dataset:
+    def __init__(self, path):
+        """ Time series of a run, read through memory maps.
+
+        Every series is a float64 .npy array of shape (steps, agents), so the
+        values of one step are contiguous and series[step] is the step vector
+        of all agents. Nothing is read from disk until it is used.
+
+        Args:
+            path (str): directory with demand.npy, supply.npy, price.npy and
+                nodes.npy
+        """
+        self.path = path
+        self.demand = np.load(os.path.join(path, 'demand.npy'), mmap_mode='r')
+        self.supply = np.load(os.path.join(path, 'supply.npy'), mmap_mode='r')
+        self.price = np.load(os.path.join(path, 'price.npy'), mmap_mode='r')
+        self.nodes = np.load(os.path.join(path, 'nodes.npy'), mmap_mode='r')
+        self.num_steps, self.num_agents = self.demand.shape
+        if self.supply.shape != self.demand.shape or self.price.shape != self.demand.shape or \
+                self.nodes.shape != (self.num_agents,):
+            raise ValueError("Series of different shapes in {}: demand {}, supply {}, price {}, nodes {}".format(
+                path, self.demand.shape, self.supply.shape, self.price.shape, self.nodes.shape))
+
+    def step(self, step):
+        """ Demand, supply and price of every agent for a step. """
+        return self.demand[step], self.supply[step], self.price[step]
+
+    def gen_nodes(self, num_agents=None, num_steps=None):
+        """ Agents with supply in any step, reading a block of steps at a time.
+
+        Args:
+            num_agents (int): only the first agents are considered if given
+            num_steps (int): only the first steps are considered if given
+        """
+        num_agents = self.num_agents if num_agents is None else num_agents
+        num_steps = self.num_steps if num_steps is None else num_steps
+        generates = np.zeros(num_agents, dtype=bool)
+        for start in range(0, num_steps, _chunk_steps):
+            block = self.supply[start:min(start + _chunk_steps, num_steps), :num_agents]
+            generates |= (block != 0).any(axis=0)
+        return np.flatnonzero(generates)
+
+
+def share_array(array):
+    """ Copy an array into a new shared memory block.
+
+    Returns:
+        memory (SharedMemory): the block, to be closed and unlinked by its creator
+        spec (tuple): (name, shape, dtype) attaching the block in another process
+    """
+    array = np.asarray(array)
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """ Read only view of an array shared by share_array.
+
+    Returns:
+        memory (SharedMemory): the block, to be closed once the view is dropped
+        array (np.ndarray): view of the shared array
+    """
+    name, shape, dtype = spec
+    # Worker processes share the resource tracker of their parent, attaching
+    # registers the block there again, which is harmless
+    memory = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    array.flags.writeable = False
+    return memory, array
+
+
+class SharedDataset(Dataset):
+    def __init__(self, specs):
+        """ Dataset whose series live in shared memory blocks.
+
+        Built with share in the parent process, then attached in workers from
+        its specs, so the series are mapped by every process instead of being
+        pickled to each of them.
+
+        Args:
+            specs (dict): share_array spec of every series and of nodes
+        """
+        self.path = None
+        self.specs = specs
+        self._memory = []
+        self._owner = False
+        for name, spec in specs.items():
+            memory, array = attach_array(spec)
+            self._memory.append(memory)
+            setattr(self, name, array)
+        self.num_steps, self.num_agents = self.demand.shape
+
+    @classmethod
+    def share(cls, dataset):
+        """ Copy a dataset into shared memory, owned by the returned dataset. """
+        shared = cls.__new__(cls)
+        shared.path = None
+        shared.specs = {}
+        shared._memory = []
+        shared._owner = True
+        for name in series + ('nodes',):
+            memory, spec = share_array(getattr(dataset, name))
+            array = np.ndarray(spec[1], dtype=spec[2], buffer=memory.buf)
+            array.flags.writeable = False
+            shared.specs[name] = spec
+            shared._memory.append(memory)
+            setattr(shared, name, array)
+        shared.num_steps, shared.num_agents = shared.demand.shape
+        return shared
+
+    def close(self):
+        """ Drop the views, and free the blocks if this dataset created them. """
+        for name in self.specs:
+            setattr(self, name, None)
+        for memory in self._memory:
+            memory.close()
+            if self._owner:
+                memory.unlink()
+        self._memory = []
+
+
+def _create(path, name, num_steps, num_agents):
+    return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                     dtype=np.float64, shape=(num_steps, num_agents))
+
+
+def convert_csv(source, path):
+    """ Convert the CSV series of source into a dataset at path.
+
+    The CSV files have one row per agent, starting with its node id, and one
+    column per step. They are parsed a block of agents at a time and written
+    transposed, so files larger than memory can be converted. Series with
+    more steps than the others are cut to the common steps with a warning,
+    different agents or node ids raise a ValueError.
+
+    Args:
+        source (str): directory with demand.csv, supply.csv and price.csv
+        path (str): directory receiving the dataset
+    """
+    os.makedirs(path, exist_ok=True)
+    shapes = {}
+    for name in series:
+        with open(os.path.join(source, name + '.csv')) as csv_file:
+            num_steps = len(csv_file.readline().split(',')) - 1
+            shapes[name] = (num_steps, 1 + sum(1 for line in csv_file if line.strip()))
+    if len({num_agents for _, num_agents in shapes.values()}) > 1:
+        raise ValueError("Series of {} have different agents: {}".format(source, shapes))
+    num_steps = min(steps for steps, _ in shapes.values())
+    num_agents = shapes[series[0]][1]
+    if any(steps != num_steps for steps, _ in shapes.values()):
+        warnings.warn("Series of {} have different steps {}, only the first {} are kept".format(
+            source, {name: steps for name, (steps, _) in shapes.items()}, num_steps))
+
+    nodes = None
+    for name in series:
+        values = _create(path, name, num_steps, num_agents)
+        series_nodes = np.empty(num_agents, dtype=np.int64)
+        start = 0
+        for chunk in pd.read_csv(os.path.join(source, name + '.csv'), header=None, index_col=0,
+                                 chunksize=_chunk_rows):
+            stop = start + len(chunk)
+            values[:, start:stop] = chunk.values[:, :num_steps].T
+            series_nodes[start:stop] = chunk.index
+            start = stop
+        values.flush()
+        del values
+        if nodes is None:
+            nodes = series_nodes
+        elif not np.array_equal(nodes, series_nodes):
+            raise ValueError("{}.csv of {} has other node ids than {}.csv".format(name, source, series[0]))
+    np.save(os.path.join(path, 'nodes.npy'), nodes)
+    return Dataset(path)
+
+
+def synthesize(path, num_steps, num_agents, num_gens, seed=None):
+    """ Write a synthetic dataset with the distributions of
+    main.create_synthetic_data, a block of steps at a time.
+
+    Args:
+        path (str): directory receiving the dataset
+        num_steps (int): number of steps
+        num_agents (int): number of agents
+        num_gens (int): number of agents with no generation
+        seed (int): seed of the random values, the global numpy state if None
+    """
+    random = np.random if seed is None else np.random.RandomState(seed)
+    os.makedirs(path, exist_ok=True)
+    no_generation = random.choice(num_agents, size=(num_gens,), replace=False)
+    demand = _create(path, 'demand', num_steps, num_agents)
+    price = _create(path, 'price', num_steps, num_agents)
+    supply = _create(path, 'supply', num_steps, num_agents)
+    for start in range(0, num_steps, _chunk_steps):
+        steps = slice(start, min(start + _chunk_steps, num_steps))
+        size = (steps.stop - steps.start, num_agents)
+        demand[steps] = random.uniform(low=30, high=35, size=size)
+        price[steps] = random.uniform(low=12, high=15, size=size)
+        supply[steps] = random.uniform(low=66, high=70, size=size)
+        price[steps, no_generation] = 0
+        supply[steps, no_generation] = 0
+    for values in (demand, price, supply):
+        values.flush()
+    del demand, price, supply
+    np.save(os.path.join(path, 'nodes.npy'), np.arange(num_agents, dtype=np.int64))
+    return Dataset(path)
+
+
+def open_dataset(source, path=None):
+    """ Dataset of a directory, converting its CSV files the first time.
+
+    Args:
+        source (str): directory with a dataset or with the CSV series
+        path (str): directory of the converted dataset, source/npy if None.
+            It is converted again when a CSV file is newer than it.
+    """
+    if os.path.exists(os.path.join(source, 'demand.npy')):
+        return Dataset(source)
+    path = os.path.join(source, 'npy') if path is None else path
+    converted = os.path.join(path, 'nodes.npy')
+    if os.path.exists(converted):
+        converted_time = os.path.getmtime(converted)
+        if all(os.path.getmtime(os.path.join(source, name + '.csv')) <= converted_time
+               for name in series):
+            try:
+                return Dataset(path)
+            except ValueError:
+                # Converted before the series were checked, convert again
+                pass
+    return convert_csv(source, path)
@@ -0,0 +1,145 @@
+# Ensemble - Monte Carlo runs of the simulation over a process pool
+
+import argparse
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from addresses import provision_addresses
+from datasets import SharedDataset, attach_array, open_dataset, share_array
+from main import exec
+
+# Configuration values used when the config does not give them
+defaults = {'dlt': ['blockchain'], 'agents': [10], 'steps': [10], 'seeds': list(range(10)),
+            'options': {}, 'data': None, 'address_pool': None}
+
+# Inputs shared with the runs of a worker process, set by _init_worker
+_worker_dataset = None
+_worker_addresses = None
+
+
+def _init_worker(dataset_specs, address_spec):
+    global _worker_dataset, _worker_addresses
+    if dataset_specs is not None:
+        _worker_dataset = SharedDataset(dataset_specs)
+    _worker_addresses = attach_array(address_spec)
+
+
+def _run(dlt, agents, steps, seed, options):
+    addresses = [address.decode() for address in _worker_addresses[1][:agents]]
+    results_df = exec(dlt, agents, steps, seed=seed, data=_worker_dataset, addresses=addresses, **options)
+    return results_df.iloc[0].to_dict()
+
+
+class RunningStats:
+    def __init__(self):
+        """ Mean and variance of a sample updated one value at a time (Welford). """
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def std(self):
+        return np.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+    def interval(self, confidence=0.95):
+        """ Student t confidence interval of the mean. """
+        if self.count < 2:
+            return np.nan, np.nan
+        half = stats.t.ppf(0.5 + confidence / 2, self.count - 1) * self.std() / np.sqrt(self.count)
+        return self.mean - half, self.mean + half
+
+
+def run_ensemble(config, workers=None, confidence=0.95, progress=None):
+    """ Run every configuration of the grid with every seed on a process pool.
+
+    The dataset of config['data'], if any, and the address pool are copied
+    once into shared memory and attached by each worker when it starts, so
+    no run pickles them. Statistics are updated as runs finish.
+
+    Args:
+        config (dict): grid of dlt, agents and steps, with the seeds and the
+            options passed to exec. See defaults.
+        workers (int): worker processes, one per core if None
+        confidence (float): level of the confidence intervals
+        progress (callable): progress(summary) called after every finished run
+
+    Returns:
+        runs (pd.DataFrame): exec results of every run, with its seed
+        summary (pd.DataFrame): runs, mean, std and confidence interval of the
+            mean step time of every configuration
+    """
+    config = dict(defaults, **config)
+    cases = list(itertools.product(config['dlt'], config['agents'], config['steps']))
+    dataset = None
+    if config['data'] is not None:
+        dataset = SharedDataset.share(open_dataset(config['data']))
+    num_agents = max(config['agents']) if dataset is None else min(max(config['agents']), dataset.num_agents)
+    address_memory, address_spec = share_array(
+        np.array(provision_addresses(num_agents, pool_dir=config['address_pool']), dtype='S51'))
+
+    running = {case: RunningStats() for case in cases}
+    runs = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dataset.specs if dataset else None, address_spec)) as executor:
+            futures = {executor.submit(_run, *case, seed, config['options']): (case, seed)
+                       for case in cases for seed in config['seeds']}
+            for future in as_completed(futures):
+                case, seed = futures[future]
+                result = future.result()
+                result['seed'] = seed
+                runs.append(result)
+                running[case].add(result['mean'])
+                if progress is not None:
+                    progress(_summary(running, confidence))
+    finally:
+        address_memory.close()
+        address_memory.unlink()
+        if dataset is not None:
+            dataset.close()
+
+    runs = pd.DataFrame(runs).sort_values(['dlt', 'agents', 'steps', 'seed'], ignore_index=True)
+    return runs, _summary(running, confidence)
+
+
+def _summary(running, confidence):
+    rows = []
+    for (dlt, agents, steps), values in running.items():
+        low, high = values.interval(confidence)
+        rows.append({'dlt': dlt, 'agents': agents, 'steps': steps, 'runs': values.count,
+                     'mean': values.mean if values.count else np.nan, 'std': values.std(),
+                     'ci_low': low, 'ci_high': high})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="JSON file with the grid of configurations and the seeds",
+                        type=str)
+    parser.add_argument("--workers", help="Worker processes, one per core by default",
+                        type=int, default=None)
+    parser.add_argument("--confidence", help="Level of the confidence intervals",
+                        type=float, default=0.95)
+    parser.add_argument("--output", help="CSV file receiving the statistics of every configuration",
+                        type=str, default='ensemble_results.csv')
+    parser.add_argument("--runs", help="CSV file receiving the results of every run",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    runs, summary = run_ensemble(config, args.workers, args.confidence)
+    summary.to_csv(args.output, index=False)
+    if args.runs:
+        runs.to_csv(args.runs, index=False)
+    print(summary)
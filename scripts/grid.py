@@ -0,0 +1,356 @@
+# Grid - persistent pandapower model of the micro grid
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pandapower as pp
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import splu
+
+import timing
+from topology import check_references, partition, ring, subtopology
+
+
+class MicroGrid:
+    # voltage limits of the buses
+    min_pu = 0.95
+    max_pu = 1.05
+    line_type = '149-AL1/24-ST1A 110.0'
+
+    solvers = ('ac', 'warm', 'dc')
+
+    def __init__(self, num_agents, gen_nodes, solver='ac', topology=None):
+        """ Build the network once for the whole run.
+
+        Args:
+            num_agents (int): number of agents, one bus and one load per agent
+            gen_nodes (list): nodes of the agents that can supply power
+            solver (str): power flow used by solve. 'ac' runs Newton-Raphson
+                from a flat start, 'warm' seeds it with the previous step's
+                voltages and 'dc' solves the linearized flow with a cached
+                sparse factorization.
+            topology (Topology): lines and substations of the network, a ring
+                of all agents if None. Substation buses get an external grid
+                covering the imbalance of their feeder.
+        """
+        if solver not in self.solvers:
+            raise ValueError("Unknown solver {}, expected one of {}".format(solver, self.solvers))
+        self.num_agents = num_agents
+        self.gen_nodes = np.asarray(gen_nodes, dtype=int)
+        self.solver = solver
+        self.net = pp.create_empty_network()
+        # Generators in service in the results the warm start continues from
+        self._warm = None
+        self._bbus = None
+        self._factor = None
+
+        buses = pp.create_buses(self.net, num_agents, vn_kv=110,
+                                min_vm_pu=self.min_pu, max_vm_pu=self.max_pu)
+        self.topology = ring(num_agents) if topology is None else topology
+        pp.create_lines(self.net, buses[self.topology.from_bus], buses[self.topology.to_bus],
+                        length_km=self.topology.length_km, std_type=self.line_type)
+        for substation in self.topology.substations:
+            pp.create_ext_grid(self.net, buses[substation], vm_pu=1.0)
+        pp.create_loads(self.net, buses, p_mw=0.0)
+        # Generators are indexed by node so res_gen maps straight to agents
+        pp.create_gens(self.net, buses[self.gen_nodes], p_mw=0.0, min_p_mw=0.0,
+                       max_p_mw=0.0, controllable=True, slack=True,
+                       index=self.gen_nodes)
+        timing.recorder.count('grid_elements', len(self.net.bus) + len(self.net.line) +
+                              len(self.net.load) + len(self.net.gen) + len(self.net.ext_grid))
+
+    def update(self, demand, supply):
+        """ Write the step values into the network.
+
+        Args:
+            demand (np.ndarray): demand of every agent for the step
+            supply (np.ndarray): supply of every agent for the step
+        """
+        gen_supply = np.asarray(supply, dtype=float)[self.gen_nodes]
+        self.net.load['p_mw'] = np.asarray(demand, dtype=float)
+        self.net.gen['max_p_mw'] = gen_supply
+        # Agents without supply in this step are left out as in a rebuild
+        self.net.gen['in_service'] = gen_supply != 0
+
+    def solve(self, demand, supply):
+        """ Run the power flow for one step with the selected solver.
+
+        Args:
+            demand (np.ndarray): demand of every agent for the step
+            supply (np.ndarray): supply of every agent for the step
+
+        Returns:
+            pf_result (pd.DataFrame): res_gen of the in service generators
+        """
+        if self.solver == 'dc':
+            return self.solve_dc(demand, supply)
+        self.update(demand, supply)
+        in_service = self.net.gen['in_service'].values.copy()
+        # A generator coming back turns a PQ bus into a slack bus, whose
+        # previous angle is not a valid start, so it runs from a flat start
+        if self.solver == 'warm' and self._warm is not None and np.array_equal(self._warm, in_service):
+            pp.runpp(self.net, init='results')
+        else:
+            pp.runpp(self.net)
+        self._warm = in_service
+        return self.net.res_gen.loc[self.net.gen['in_service']]
+
+    def solve_dc(self, demand, supply):
+        """ Linearized power flow with every generator bus as reference.
+
+        Generator and substation buses are slack buses at angle zero, so the
+        remaining bus angles follow from the reduced susceptance matrix. Its LU
+        factorization is kept and reused for as long as the set of generators
+        in service does not change.
+
+        Args:
+            demand (np.ndarray): demand of every agent for the step
+            supply (np.ndarray): supply of every agent for the step
+
+        Returns:
+            pf_result (pd.DataFrame): p_mw, q_mvar, va_degree and vm_pu of the
+                in service generators, indexed by node
+        """
+        demand = np.asarray(demand, dtype=float)
+        in_service = self.gen_nodes[np.asarray(supply, dtype=float)[self.gen_nodes] != 0]
+        if self._bbus is None:
+            self._bbus = self._susceptance_matrix()
+        if self._factor is None or not np.array_equal(self._factor[0], in_service):
+            free = np.setdiff1d(np.arange(self.num_agents),
+                                np.union1d(in_service, self.topology.substations))
+            lu = splu(self._bbus[free][:, free].tocsc()) if len(free) else None
+            self._factor = (in_service, free, lu)
+        in_service, free, lu = self._factor
+
+        sn_mva = self.net.sn_mva
+        theta = np.zeros(self.num_agents)
+        if lu is not None:
+            theta[free] = lu.solve(-demand[free] / sn_mva)
+        injection = self._bbus[in_service] @ theta * sn_mva
+        self.va_degree = np.degrees(theta)
+
+        pf_result = pd.DataFrame({'p_mw': injection + demand[in_service],
+                                  'q_mvar': 0.0,
+                                  'va_degree': 0.0,
+                                  'vm_pu': 1.0}, index=in_service)
+        return pf_result
+
+    def _susceptance_matrix(self):
+        """ Bus susceptance matrix in per unit built from the line table. """
+        line = self.net.line
+        z_base = self.net.bus['vn_kv'].values[line['from_bus'].values] ** 2 / self.net.sn_mva
+        x_pu = line['x_ohm_per_km'].values * line['length_km'].values / line['parallel'].values / z_base
+        b = 1 / x_pu
+        f = line['from_bus'].values
+        t = line['to_bus'].values
+        rows = np.concatenate([f, t, f, t])
+        cols = np.concatenate([f, t, t, f])
+        data = np.concatenate([b, b, -b, -b])
+        return coo_matrix((data, (rows, cols)), shape=(self.num_agents, self.num_agents)).tocsr()
+
+    def deviation(self, demand, supply, fast=None):
+        """ Compare the selected solver with a full flat start AC power flow.
+
+        Args:
+            demand (np.ndarray): demand of every agent for the step
+            supply (np.ndarray): supply of every agent for the step
+            fast (pd.DataFrame): result of the last solve of this step, the
+                step is solved again if None
+
+        Returns:
+            deviation (dict): largest absolute difference in generator p_mw,
+                bus voltage angle (degrees) and bus voltage magnitude (pu)
+        """
+        if fast is None:
+            fast = self.solve(demand, supply)
+        if self.solver == 'dc':
+            va_degree = self.va_degree
+            vm_pu = np.ones(self.num_agents)
+        else:
+            va_degree = self.net.res_bus['va_degree'].values.copy()
+            vm_pu = self.net.res_bus['vm_pu'].values.copy()
+
+        self.update(demand, supply)
+        pp.runpp(self.net, init='flat')
+        full = self.net.res_gen.loc[self.net.gen['in_service']]
+
+        deviation = {'p_mw': float(np.max(np.abs(fast['p_mw'].values - full['p_mw'].values), initial=0.0)),
+                     'va_degree': float(np.max(np.abs(va_degree - self.net.res_bus['va_degree'].values))),
+                     'vm_pu': float(np.max(np.abs(vm_pu - self.net.res_bus['vm_pu'].values)))}
+        return deviation
+
+
+class PartitionedGrid:
+    def __init__(self, num_agents, gen_nodes, solver='ac', topology=None, workers=1):
+        """ Network split into its feeders, each solved as its own MicroGrid.
+
+        Feeders are only connected through their substations, so their power
+        flows are independent. With several workers the feeders are grouped
+        into one batch per worker and the batches are solved concurrently on
+        a process pool, where each worker builds the grids of its feeders
+        the first time it solves them.
+
+        Args:
+            num_agents (int): number of agents
+            gen_nodes (list): nodes of the agents that can supply power
+            solver (str): power flow solver of every feeder, see MicroGrid
+            topology (Topology): lines and substations, a ring if None
+            workers (int): processes solving feeders, in process if 1
+        """
+        self.num_agents = num_agents
+        self.topology = ring(num_agents) if topology is None else topology
+        self.solver = solver
+        self.parts = partition(self.topology)
+        self.gen_nodes = np.asarray(gen_nodes, dtype=int)
+        check_references(self.topology, self.parts, self.gen_nodes)
+        self.feeders = [_feeder(self.topology, nodes, self.gen_nodes) for nodes in self.parts]
+        self._executor = None
+        self._grids = None
+        if workers > 1 and len(self.parts) > 1:
+            # Batches of about the same number of buses, largest feeders first
+            self.batches = [[] for _ in range(min(workers, len(self.parts)))]
+            sizes = np.zeros(len(self.batches))
+            for part in sorted(range(len(self.parts)), key=lambda part: -len(self.parts[part])):
+                batch = int(np.argmin(sizes))
+                self.batches[batch].append(part)
+                sizes[batch] += len(self.parts[part])
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_feeders,
+                                                 initargs=(self.feeders, solver))
+        else:
+            self._grids = [MicroGrid(topology.num_agents, gens, solver, topology)
+                           for topology, gens in self.feeders]
+
+    def solve(self, demand, supply):
+        """ Solve every feeder and merge their generators.
+
+        Args:
+            demand (np.ndarray): demand of every agent for the step
+            supply (np.ndarray): supply of every agent for the step
+
+        Returns:
+            pf_result (pd.DataFrame): p_mw, q_mvar, va_degree and vm_pu of the
+                in service generators, indexed by node
+        """
+        demand = np.asarray(demand, dtype=float)
+        supply = np.asarray(supply, dtype=float)
+        if self._executor is None:
+            results = [grid.solve(demand[nodes], supply[nodes])[_result_columns]
+                       for grid, nodes in zip(self._grids, self.parts)]
+            parts = range(len(self.parts))
+        else:
+            futures = [self._executor.submit(_solve_feeders, batch,
+                                             [demand[self.parts[part]] for part in batch],
+                                             [supply[self.parts[part]] for part in batch])
+                       for batch in self.batches]
+            results = [result for future in futures for result in future.result()]
+            parts = [part for batch in self.batches for part in batch]
+        merged = []
+        for part, pf_result in zip(parts, results):
+            pf_result.index = self.parts[part][pf_result.index.values]
+            merged.append(pf_result)
+        return pd.concat(merged).sort_index()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Generator results merged from the feeders
+_result_columns = ['p_mw', 'q_mvar', 'va_degree', 'vm_pu']
+
+
+def _feeder(topology, nodes, gen_nodes):
+    """ Local topology and generator nodes of a feeder. """
+    return subtopology(topology, nodes), np.flatnonzero(np.isin(nodes, gen_nodes))
+
+
+def create_grid(num_agents, gen_nodes, solver='ac', topology=None, workers=1):
+    """ MicroGrid of the whole network, or a PartitionedGrid if it has several feeders. """
+    if topology is None:
+        return MicroGrid(num_agents, gen_nodes, solver)
+    parts = partition(topology)
+    if len(parts) == 1:
+        check_references(topology, parts, gen_nodes)
+        return MicroGrid(num_agents, gen_nodes, solver, topology)
+    return PartitionedGrid(num_agents, gen_nodes, solver, topology, workers)
+
+
+# Feeder grids of each partitioned power flow worker, built on first use
+_worker_feeders = None
+_worker_solver = None
+_worker_feeder_grids = {}
+
+
+def _init_feeders(feeders, solver):
+    global _worker_feeders, _worker_solver
+    _worker_feeders = feeders
+    _worker_solver = solver
+
+
+def _solve_feeders(parts, demands, supplies):
+    results = []
+    for part, demand, supply in zip(parts, demands, supplies):
+        grid = _worker_feeder_grids.get(part)
+        if grid is None:
+            topology, gens = _worker_feeders[part]
+            grid = _worker_feeder_grids[part] = MicroGrid(topology.num_agents, gens, _worker_solver, topology)
+        results.append(grid.solve(demand, supply)[_result_columns])
+    return results
+
+
+# Network of each power flow worker process, built once by _init_worker
+_worker_grid = None
+
+
+def _init_worker(num_agents, gen_nodes, solver, topology):
+    global _worker_grid
+    _worker_grid = create_grid(num_agents, gen_nodes, solver, topology)
+
+
+def _solve_step(demand, supply):
+    pf_result = _worker_grid.solve(demand, supply)
+    return pf_result['p_mw'].to_dict()
+
+
+def solve_steps(demand, supply, gen_nodes, workers=None, solver='ac', window=None, topology=None):
+    """ Solve the power flow of every step on a process pool.
+
+    The physical results only depend on each step's demand and supply
+    columns, so steps are independent. Every worker builds its MicroGrid once
+    and only receives the column vectors of the steps it solves.
+
+    Args:
+        demand (np.ndarray): demand per agent (rows) and step (columns)
+        supply (np.ndarray): supply per agent (rows) and step (columns)
+        gen_nodes (list): nodes of the agents that can supply power
+        workers (int): number of worker processes, one per core if None
+        solver (str): power flow solver of the workers, see MicroGrid
+        window (int): maximum number of steps in flight. All steps are
+            submitted up front if None.
+        topology (Topology): lines and substations, a ring if None
+
+    Yields:
+        gen_dict (dict): generator p_mw by node, in step order
+    """
+    demand = np.asarray(demand, dtype=float)
+    supply = np.asarray(supply, dtype=float)
+    num_agents, num_steps = demand.shape
+    if window is None:
+        window = num_steps
+    if topology is not None:
+        # Fail here rather than in the initializer of every worker
+        check_references(topology, partition(topology), gen_nodes)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(num_agents, np.asarray(gen_nodes), solver, topology)) as executor:
+        pending = deque()
+        next_step = 0
+        for step in range(num_steps):
+            while next_step < num_steps and len(pending) < max(window, 1):
+                pending.append(executor.submit(_solve_step, demand[:, next_step].copy(),
+                                               supply[:, next_step].copy()))
+                next_step += 1
+            yield pending.popleft().result()
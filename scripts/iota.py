@@ -1,5 +1,164 @@
 # IOTA - Agent class definition
 
+import json
+
+from tangle import ProposedTransaction, Address, Tag, TryteString, Transaction, LocalTangle, join_fragments
+
+# Node used by the agents, a local tangle unless connect is called
+api = LocalTangle()
+
+
+def connect(node):
+    """ Point the agents to another node with the same API, e.g. a
+    LocalTangle with a different min_weight_magnitude.
+
+    Args:
+        node (LocalTangle): node receiving the agents' transactions
+    """
+    global api
+    api = node
+
+
+def decode_messages(trytes):
+    """ Decode the JSON messages of a list of transaction trytes.
+
+    The fragments of a transfer are grouped by bundle and address and
+    joined in bundle index order, so a message longer than one transaction
+    is decoded as a whole.
+
+    Args:
+        trytes (list): tryte strings of the transactions
+
+    Returns:
+        messages (dict): decoded messages by address, one per bundle.
+            Transfers that are not a JSON message are skipped.
+    """
+    parts = {}
+    for trytestring in trytes:
+        tx = Transaction.from_tryte_string(trytestring)
+        key = (str(tx.bundle_hash), str(tx.address))
+        parts.setdefault(key, []).append((tx.current_index, tx.signature_message_fragment))
+
+    messages = {}
+    for (bundle, address), fragments in parts.items():
+        fragments.sort(key=lambda x: x[0])
+        address_messages = messages.setdefault(address, [])
+        text = join_fragments(fragment for index, fragment in fragments).decode(errors='ignore')
+        if not text:
+            continue
+        try:
+            address_messages.append(json.loads(text))
+        except ValueError:
+            continue
+    return messages
+
+
+class AddressReader:
+    def __init__(self):
+        """ Cache of the decoded messages of the addresses read in each step.
+
+        prefetch reads any number of addresses with one find_transactions and
+        one get_trytes call, and the decoded messages are kept until evict is
+        called for their step.
+        """
+        self.cache = {}
+
+    def prefetch(self, step, addresses):
+        """ Read and decode the messages of many addresses in one round.
+
+        Args:
+            step (int): step the addresses belong to
+            addresses (list): addresses to read
+        """
+        step_cache = self.cache.setdefault(step, {})
+        missing = [address for address in addresses if str(Address(address)) not in step_cache]
+        if not missing:
+            return
+        hashes = api.find_transactions(addresses=missing)['hashes']
+        trytes = api.get_trytes(hashes)['trytes'] if hashes else []
+        messages = decode_messages(trytes)
+        for address in missing:
+            address = str(Address(address))
+            step_cache[address] = messages.get(address, [])
+
+    def read(self, step, address):
+        """ Messages of an address, fetched on its own if not prefetched. """
+        address = str(Address(address))
+        if address not in self.cache.get(step, {}):
+            self.prefetch(step, [address])
+        return self.cache[step][address]
+
+    def evict(self, step):
+        """ Drop the messages of a settled step. """
+        self.cache.pop(step, None)
+
+
+def create_agents(demand, supply, price):
+    """ One Agent per node, with a price and a money address for every step.
+
+    The addresses are drawn from api in one call and the agents share the
+    address dict and an AddressReader.
+
+    Args:
+        demand (np.ndarray): demand per step (rows) and agent (columns)
+        supply (np.ndarray): supply per step (rows) and agent (columns)
+        price (np.ndarray): offer price per step (rows) and agent (columns)
+
+    Returns:
+        agents (list): Agent of every node
+    """
+    steps, num_agents = demand.shape
+    per_agent = 2 * steps + 1
+    addresses = api.get_new_addresses(index=0, count=num_agents * per_agent)['addresses']
+    agents = []
+    address_dict = {}
+    for node in range(num_agents):
+        own = addresses[node * per_agent:(node + 1) * per_agent]
+        agent = Agent(demand[:, node], supply[:, node], node, own[0], own[1:steps + 1],
+                      own[steps + 1:], price[:, node])
+        address_dict[node] = {'price_address': agent.price_address,
+                              'money_address': agent.money_address}
+        agents.append(agent)
+    reader = AddressReader()
+    for agent in agents:
+        agent.assign_address_dict(address_dict)
+        agent.assign_reader(reader)
+    return agents
+
+
+def payment_bundles(step, agents, payers):
+    """ Payment bundle of every payer of a step, reading all price addresses in one round.
+
+    Args:
+        step (int): step running at the moment
+        agents (list): Agent of every node, as given by create_agents
+        payers (list): nodes paying in this step
+
+    Returns:
+        bundles (list): (data, address) pairs of every bundle with payments
+    """
+    if not len(payers):
+        return []
+    reader = agents[payers[0]].reader
+    reader.prefetch(step, [agents[payer].price_address[step] for payer in payers])
+    bundles = [agents[payer].payment_messages(step) for payer in payers]
+    reader.evict(step)
+    return [bundle for bundle in bundles if bundle]
+
+
+def pay_step(step, agents, payers):
+    """ Send the payments of a step one bundle after another, see
+    submission.publish_step for concurrent sends.
+
+    Args:
+        step (int): step running at the moment
+        agents (list): Agent of every node, as given by create_agents
+        payers (list): nodes paying in this step
+    """
+    for bundle in payment_bundles(step, agents, payers):
+        agents[payers[0]].publish_many(bundle)
+
+
 class Agent:
     def __init__(self, demand, supply, node, publish_address, price_address, money_address, price):
         """ Initialize agent instance.
@@ -43,17 +202,43 @@ class Agent:
             pass
         return result
 
+    def publish_many(self, messages):
+        """ Send several messages as the outputs of a single bundle
+
+        Args:
+            messages (list): (data, address) pairs to be sent.
+        """
+        transfers = [ProposedTransaction(
+            address = Address(address),
+            message = TryteString.from_unicode(json.dumps(data)),
+            tag = Tag('INFO'),
+            value = 0) for data, address in messages]
+        tx = api.prepare_transfer(transfers=transfers)
+        return api.send_trytes(tx['trytes'], depth=3, min_weight_magnitude=9)
+
     def pay_power(self, step):
-        """ Send power payment
+        """ Send power payment, one bundle with an output per seller
+
+        Args:
+            step (float): step running at the moment.
+        """
+        messages = self.payment_messages(step)
+        if messages:
+            self.publish_many(messages)
+
+    def payment_messages(self, step):
+        """ Payment to every seller of the step, as (data, address) pairs
 
         Args:
             step (float): step running at the moment.
         """
         unpack_data = self.check_address(step, 'price')
+        messages = []
         for index, node in enumerate(unpack_data[0]['node']):
             data_to_send = {'payment': unpack_data[0]['price']*unpack_data[0]['power'][index]}
             address = self.address_dict[node]['money_address'][step]
-            self.publish_info(data_to_send, address)
+            messages.append((data_to_send, address))
+        return messages
 
     def check_address(self, step, address_type):
         """ Recover information from address.
@@ -68,30 +253,13 @@ class Agent:
         elif address_type == 'money':
             address = self.money_address[step]
 
-        transactions = api.find_transactions(addresses=[address,])
-
-        hashes = []
-        for txhash in transactions['hashes']:
-            hashes.append(txhash)
-
-        trytes = api.get_trytes(hashes)['trytes']
-
-        parts = []
-        for trytestring in trytes:
-            tx = Transaction.from_tryte_string(trytestring)
-            parts.append((tx.current_index, tx.signature_message_fragment))
+        reader = getattr(self, 'reader', None)
+        if reader is not None:
+            return reader.read(step, address)
 
-        parts.sort(key=lambda x: x[0])
-
-        full_message = TryteString.from_unicode('')
-
-        retrieved_data = []
-        for index, part in parts:
-            try:
-                retrieved_data.append(json.loads(part.decode(errors='ignore')))
-            except:
-                pass
-        return retrieved_data
+        transactions = api.find_transactions(addresses=[address,])
+        trytes = api.get_trytes(transactions['hashes'])['trytes']
+        return decode_messages(trytes).get(str(Address(address)), [])
 
     def publish_energy_info(self, step):
         agents_info = {}
@@ -138,3 +306,11 @@ class Agent:
             address_dict (dict): With known addresses for each node (price and money) and publish addresses
         """
         self.address_dict = address_dict
+
+    def assign_reader(self, reader):
+        """ Read addresses through a shared cache
+
+        Args:
+            reader (AddressReader): reader holding the prefetched messages of the step
+        """
+        self.reader = reader
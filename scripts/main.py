@@ -6,17 +6,33 @@ import numpy as np
 from numpy.random import rand
 import pandas as pd
 import os
+import tempfile
 import pprint
 import time
 from hashlib import sha256
 import time
-from bitcoinaddress import Wallet
 from tqdm import tqdm
 import argparse
+import asyncio
 
-from blockchain import Wrapper
+import iota
+from submission import SubmissionPipeline, publish_step
+from tangle import ProposedTransaction, Address, Tag, TryteString
+from blockchain import Blockchain, Wrapper
+from consensus import ProofOfWork, create_consensus, engines
+from mempool import Mempool
 
-from blockchain import Agent
+from population import AgentPopulation
+from chainstore import ChainStore
+from addresses import provision_addresses
+from timing import StageTimer, Trace, null_timer
+
+from market import clear_market
+from grid import MicroGrid, PartitionedGrid, create_grid, solve_steps
+from topology import build_topology, layouts
+from settlement import settle_payments
+from datasets import Dataset, open_dataset, synthesize
+from pipeline import LedgerWorker
 
 def create_synthetic_data(d_steps, d_num_agents, d_t_gens):
     """ Create files with fake daata
@@ -56,167 +72,332 @@ def single_sided_auction(node_data, supply, demand, price, agents):
             break
     return supply_df, ED, supply_df.iloc[index]['Price']
 
-def micro_grid_exec(step, supply, demand, price, agents):
-    net = pp.create_empty_network()
-    min_pu = 0.95
-    max_pu = 1.05
+def micro_grid_exec(step, supply, demand, price, agents, grid=None):
+    """ Run the power flow of the micro grid for one step
 
-    bus = []
-    for index in range(len(agents)):
-        bus.append(pp.create_bus(net, vn_kv=110, min_vm_pu=min_pu, max_vm_pu=max_pu))
+        Args:
+            step (int): step running at the moment
+            supply (np.ndarray): supply per step (rows) and agent (columns)
+            demand (np.ndarray): demand per step (rows) and agent (columns)
+            price (np.ndarray): offer price per step (rows) and agent (columns)
+            agents (AgentPopulation): agents of the simulation
+            grid (MicroGrid): network built once for the run, a MicroGrid or
+                PartitionedGrid. A new ring is built when not given.
+        """
+    if grid is None:
+        gen_nodes = np.flatnonzero((np.asarray(supply) != 0).any(axis=0))
+        grid = MicroGrid(len(agents), gen_nodes)
+    pf_result = grid.solve(np.array(demand[step]), np.array(supply[step]))
 
-    lines = []
-    for index in range(len(agents)):
-        if index < len(agents) - 1:
-            lines.append(pp.create_line(net, bus[index], bus[index+1], length_km=1, std_type='149-AL1/24-ST1A 110.0'))
-        else:
-            lines.append(pp.create_line(net, bus[index], bus[0], length_km=1, std_type='149-AL1/24-ST1A 110.0'))
+    return pf_result
 
-    for index in range(len(agents)):
-        pp.create_load(net, bus[index], p_mw=supply_df['Demand'][index])
+def payment_setup(step, auction_price, wrapper, supply, demand, price, agents, gen_dict, dlt='blockchain',
+                  timer=null_timer, submissions=None):
+    """ Match payers with earners and send the step payments
 
-    gens = []
-    for index in range(len(agents)):
-        if supply.iloc[index][step] != 0:
-            pp.create_gen(net, bus[index], p_mw=0, min_p_mw=0, max_p_mw=np.array(supply[step])[index], controllable=True, slack=True)
+        Args:
+            step (int): step running at the moment
+            auction_price (float): clearing price of the step
+            wrapper (Wrapper): blockchain node receiving the transactions
+            supply (np.ndarray): supply per step (rows) and agent (columns)
+            demand (np.ndarray): demand per step (rows) and agent (columns)
+            price (np.ndarray): offer price per step (rows) and agent (columns)
+            agents (AgentPopulation): agents of the simulation
+            gen_dict (dict): dispatched generation by node from the power flow
+            dlt (str): DLT used to settle the payments
+            timer (StageTimer): records the settlement and tx_creation stages
+            submissions (SubmissionPipeline): sends the iota bundles of a
+                step concurrently, one after another if None
+        """
+    with timer.stage('settlement'):
+        settlement = _match_payments(step, auction_price, supply, demand, agents, gen_dict, dlt, submissions)
 
-    pp.runpp(net)
-    pf_result = net.res_gen
+    send_payments(step, auction_price, settlement, wrapper, agents, dlt, timer, submissions)
 
-    return pf_result
+def send_payments(step, auction_price, settlement, wrapper, agents, dlt='blockchain', timer=null_timer,
+                  submissions=None):
+    """ Send the payments of a settled step
 
-def payment_setup(step, auction_price, wrapper, supply, demand, price, agents):
-    power_per_agent = []
-    for agent in agents:
-        agent.get_node()
-        demand = agent.get_demand()[step]
-        try:
-            supply = gen_dict[agent.get_node()]
-        except:
-            supply = agent.get_supply()[step]
-        to_app = supply - demand
-        if abs(to_app) < 0.00001:
-            to_app = 0
-        power_per_agent.append(to_app)
-
-    to_earn = {}
-    to_pay = {}
-    for index, payment in enumerate(power_per_agent):
-        if payment < 0:
-            to_pay[index] = abs(payment)
-        else:
-            to_earn[index] = payment
-
-    payment_info = {}
-    for payer, balance in to_pay.items():
-        payment_info[payer] = {'node': [], 'total': []}
-        for earner, gain in to_earn.items():
-            if gain > 0:
-                if balance >= gain:
-                    payment_info[payer]['node'].append(earner)
-                    payment_info[payer]['total'].append(gain)
-                    to_pay[payer] = to_pay[payer] - gain
-                    to_earn[earner] = to_earn[earner] - gain
-                elif balance < gain:
-                    payment_info[payer]['node'].append(earner)
-                    payment_info[payer]['total'].append(balance)
-                    to_pay[payer] = to_pay[payer] - balance
-                    to_earn[earner] = to_earn[earner] - balance
-                    break
-
-    gather_data = {}
-    for index, agent in enumerate(agents):
-        info_dict = {}
-        info_dict['price'] = auction_price
-        try:
-            info_dict['node'] = payment_info[index]['node']
-            info_dict['power'] = payment_info[index]['total']
-            if dlt == "blockchain":
-                info_dict['seller'] = agents[payment_info[index]['node'][0]].get_address()
-        except:
-            pass
-        gather_data[index] = info_dict
-
-    for index, agent in enumerate(agents):
-        if dlt == "blockchain":
-            data = gather_data[index]
-            agent.set_payment_data(data)
-        elif dlt == "iota":
-            address = addresses_dict[index]['price_address'][step]
-            data = gather_data[index]
-            tx = ProposedTransaction(address=Address(address), message=TryteString.from_unicode(json.dumps(data)), tag=Tag('PRICE'),value=0)
-            tx = api.prepare_transfer(transfers=[tx])
-            result = api.send_trytes(tx['trytes'], depth=3, min_weight_magnitude=9)
-
-    pay_nodes = set(nodes) - set(gen_nodes)
-    for node in pay_nodes:
+        Args:
+            step (int): step running at the moment
+            auction_price (float): clearing price of the step
+            settlement (Settlement): payments of the step
+            wrapper (Wrapper): blockchain node receiving the transactions
+            agents (AgentPopulation): agents of the simulation, a list of
+                iota.Agent for iota
+            dlt (str): DLT used to settle the payments
+            timer (StageTimer): records the tx_creation stage
+            submissions (SubmissionPipeline): sends the iota bundles of a
+                step concurrently, one after another if None
+        """
+    with timer.stage('tx_creation'):
         if dlt == "blockchain":
-            agents[node].pay_power(step, wrapper)
+            agents.set_payment_data(settlement, auction_price)
+            agents.pay_power(step, wrapper)
+        elif dlt == 'iota' and submissions is None:
+            iota.pay_step(step, agents, settlement.payers)
         elif dlt == 'iota':
-            agents[node].pay_power(step)
-
-def exec(dlt, num_agents, num_steps):
-    results_df = pd.DataFrame(columns = ['steps', 'agents', 'dlt', 'mean', 'max', 'min'])
-    d_t_gens = int(0.3 * num_agents)
-
-    demand, price, supply = create_synthetic_data(num_steps, num_agents, d_t_gens)
-    steps_vec = np.linspace(0, num_steps, num_steps + 1)
-
-    times_vec = []
-    num_agents = demand.shape[0]
-    steps = demand.shape[1]
-
-    a_series = (supply != 0).any(axis=1)
-    new_df = supply.loc[a_series]
-    gen_nodes = np.array(new_df.index)
-
-    addresses = []
-    for i in tqdm(range(0, num_agents)):
-        wallet = Wallet()
-        addresses.append(wallet.key.__dict__['mainnet'].__dict__['wif'])
-    wrapper = Wrapper()
-    agents = []
-    print('Created addresses')
-    for index in tqdm(range(0, num_agents)):
-        agents.append(Agent(np.array(demand.iloc[index]),
-                           np.array(supply.iloc[index]),
-                           index, addresses[index],
-                           np.array(price.iloc[index]), wrapper))
-    nodes = list(np.linspace(0,num_agents-1, num_agents, dtype=np.int))
-    steps_vec = list(np.linspace(0,steps-1, steps, dtype=np.int))
-    times_vec = []
-    for step in tqdm(steps_vec):
-        start = time.time()
-        step_energy_info = []
-        for index, agent in enumerate(agents):
-            node, info_dict = agent.publish_energy_info(step)
-            step_energy_info.append(info_dict)
-        supply_df, ED, auction_price = single_sided_auction(step_energy_info,supply, demand, price, agents)
-        pf_result = micro_grid_exec(step, supply, demand, price, agents)
-        supply_df.set_index('Agents', inplace=True)
-        gen_values = pf_result['p_mw']
-        gen_dict = dict(zip(gen_nodes, gen_values))
-        total_demand = sum(supply_df['Demand'])
-        total_supply = sum(gen_dict.values())
-        losses = total_supply - total_demand
-        payment_setup(step, auction_price, wrapper, supply, demand, price, agents)
-        wrapper.mine_unconfirmed_transactions()
-        times_vec.append(time.time()-start)
-    new_df = pd.DataFrame(data={'steps': [d_steps],
-                                 'agents': [d_num_agents],
-                                 'dlt': ['blockchain'],
-                                 'mean': [np.mean(times_vec)],
-                                 'max': [np.max(times_vec)],
-                                 'min': [np.min(times_vec)]})
-    results_df = results_df.append(new_df, ignore_index = True)
-
-parser = argparse.ArgumentParser()
-parser.add_argument("dlt", help="Select DLT to test",
-                    type=str)
-parser.add_argument("num_agents", help="Number of agents",
-                    type=int)
-parser.add_argument("num_steps", help="Number of steps",
-                    type=str)
-args = parser.parse_args()
-
-exec(args.dlt, args.num_agents, args.num_steps)
+            asyncio.run(publish_step(submissions, iota.payment_bundles(step, agents, settlement.payers)))
+
+def _match_payments(step, auction_price, supply, demand, agents, gen_dict, dlt, submissions=None):
+    step_supply = np.array(supply[step], dtype=float)
+    gen_index = np.fromiter(gen_dict.keys(), dtype=int, count=len(gen_dict))
+    step_supply[gen_index] = np.fromiter(gen_dict.values(), dtype=float, count=len(gen_dict))
+    power_per_agent = step_supply - np.array(demand[step], dtype=float)
+
+    settlement = settle_payments(power_per_agent)
+    if dlt == "blockchain":
+        return settlement
+
+    bundles = []
+    for index, payer in enumerate(settlement.payers):
+        start, end = settlement.offsets[index], settlement.offsets[index + 1]
+        if dlt == "iota":
+            address = agents[payer].price_address[step]
+            data = {'price': float(np.squeeze(auction_price)),
+                    'node': settlement.earners[start:end].tolist(),
+                    'power': settlement.amounts[start:end].tolist()}
+            bundles.append([(data, address)])
+    if submissions is not None:
+        # The payers read these prices, so they are stored before the payments start
+        asyncio.run(publish_step(submissions, bundles, 'PRICE'))
+        return settlement
+    for [(data, address)] in bundles:
+        tx = ProposedTransaction(address=Address(address), message=TryteString.from_unicode(json.dumps(data)), tag=Tag('PRICE'),value=0)
+        tx = iota.api.prepare_transfer(transfers=[tx])
+        result = iota.api.send_trytes(tx['trytes'], depth=3, min_weight_magnitude=9)
+    return settlement
+
+def exec(dlt, num_agents, num_steps, solver='ac', pf_workers=1, mining_workers=1, chain_store=None,
+         address_pool=None, seed=None, timer=None, data=None, pipeline_depth=0,
+         addresses=None, consensus='pow', authorities=1, block_size=None, block_bytes=None,
+         mempool_size=None, mempool_order='fifo', fee_rate=0.0, topology='ring', feeders=1, feeder_workers=1,
+         check_deviation=False, submit_concurrency=8):
+    """ Run the whole simulation
+
+        Args:
+            dlt (str): DLT used to settle the payments
+            num_agents (int): number of agents
+            num_steps (int): number of steps
+            solver (str): power flow solver, see MicroGrid
+            pf_workers (int): processes solving the power flow ahead of the ledger
+            mining_workers (int): processes searching the proof of work nonce
+            chain_store (str): directory persisting the mined blocks
+            address_pool (str): directory keeping the generated agent addresses
+            seed (int): seed of the synthetic data
+            timer (StageTimer): records the time of every stage, a Trace also
+                records the counters, memory and profile of the run
+            data (str): directory with a dataset or CSV series, see
+                datasets.open_dataset, or an open Dataset. Its first num_agents
+                agents and num_steps steps are used. Synthetic data is
+                generated if None.
+            pipeline_depth (int): steps that can wait for the ledger while
+                the next ones are cleared and solved. The ledger work of a
+                step runs on its own thread if positive, in line if 0.
+            addresses (list): address of every agent, provisioned from
+                address_pool if None
+            consensus (str): block sealing, see consensus.create_consensus
+            authorities (int): agents sealing the blocks under 'poa'
+            block_size (int): transactions per block, a step is cut into as
+                many blocks as needed. Unbounded if None.
+            block_bytes (int): bytes per block, unbounded if None
+            mempool_size (int): pending transactions kept, further ones are
+                dropped. Unbounded if None.
+            mempool_order (str): 'fifo' or 'fee' order of the mempool
+            fee_rate (float): fee the agents offer per unit of payment
+            topology (str): layout of the grid, see topology.build_topology.
+                'data' reads lines.csv from the data directory.
+            feeders (int): feeders of the radial layout, clusters of the meshed one
+            feeder_workers (int): processes solving the feeders of a step concurrently
+            check_deviation (bool): compare every power flow with a flat start
+                AC one and count the largest deviations in the timer, as
+                deviation_p_mw, deviation_va_degree and deviation_vm_pu
+            submit_concurrency (int): iota bundles sent at the same time, 0
+                sends them one after another
+
+        Returns:
+            results_df (pd.DataFrame): mean, max and min wall time per step
+        """
+    if check_deviation and pf_workers > 1:
+        raise ValueError("The deviation is only checked on power flows solved in line")
+    if timer is None:
+        timer = StageTimer()
+    workspace = None
+    with timer:
+        with timer.stage('data_generation'):
+            if data is None:
+                workspace = tempfile.TemporaryDirectory()
+                dataset = synthesize(workspace.name, num_steps, num_agents, int(0.3 * num_agents), seed)
+            elif isinstance(data, Dataset):
+                dataset = data
+            else:
+                dataset = open_dataset(data)
+        # Memory mapped views, one step is one contiguous row
+        demand = dataset.demand[:num_steps, :num_agents]
+        supply = dataset.supply[:num_steps, :num_agents]
+        price = dataset.price[:num_steps, :num_agents]
+        steps, num_agents = demand.shape
+        gen_nodes = dataset.gen_nodes(num_agents, steps)
+
+        with timer.stage('setup'):
+            if addresses is None:
+                addresses = provision_addresses(num_agents, pool_dir=address_pool)
+            addresses = addresses[:num_agents]
+            engine = create_consensus(consensus, addresses, authorities, Blockchain.difficulty, mining_workers)
+            mempool = Mempool(mempool_size, None, block_size, block_bytes, mempool_order)
+            wrapper = Wrapper(mining_workers, ChainStore(chain_store) if chain_store else None, engine, mempool)
+            layout = build_topology(topology, num_agents, feeders, seed or 0,
+                                    data if isinstance(data, str) else getattr(data, 'path', None),
+                                    gen_nodes)
+            grid = None
+            if pf_workers <= 1:
+                grid = create_grid(num_agents, gen_nodes, solver, layout, feeder_workers)
+            if check_deviation and not isinstance(grid, MicroGrid):
+                raise ValueError("The deviation is only checked on a grid with a single feeder")
+            submissions = None
+            if dlt == 'iota':
+                agents = iota.create_agents(demand, supply, price)
+                if submit_concurrency > 0:
+                    submissions = SubmissionPipeline(submit_concurrency)
+            else:
+                agents = AgentPopulation(demand, supply, price, addresses, wrapper=wrapper, fee_rate=fee_rate)
+        steps_vec = list(np.linspace(0,steps-1, steps, dtype=int))
+        times_vec = []
+        if pf_workers > 1:
+            # Power flow only depends on the step vectors, solve them ahead on a pool
+            gen_dicts = solve_steps(demand.T, supply.T, gen_nodes, pf_workers, solver,
+                                    window=2 * pf_workers, topology=layout)
+        ledger = None
+        if pipeline_depth > 0:
+            def ledger_step(step, auction_price, settlement):
+                # Memory is only sampled by the main thread, see Trace.end_step
+                timer.set_step(step)
+                send_payments(step, auction_price, settlement, wrapper, agents, dlt, timer, submissions)
+                wrapper.mine_unconfirmed_transactions(timer)
+                timer.set_step(None)
+            ledger = LedgerWorker(ledger_step, pipeline_depth)
+            started = {}
+        for step in tqdm(steps_vec):
+            step = int(step)
+            timer.begin_step(step)
+            start = time.perf_counter()
+            with timer.stage('auction'):
+                auction_price, marginal_agent, dispatch = clear_market(demand[step], supply[step], price[step])
+            with timer.stage('power_flow'):
+                if pf_workers > 1:
+                    gen_dict = next(gen_dicts)
+                else:
+                    pf_result = micro_grid_exec(step, supply, demand, price, agents, grid)
+                    gen_dict = pf_result['p_mw'].to_dict()
+            if check_deviation:
+                with timer.stage('deviation'):
+                    deviation = grid.deviation(demand[step], supply[step], pf_result)
+                for name, value in deviation.items():
+                    timer.count('deviation_' + name, value)
+            total_demand = demand[step].sum()
+            total_supply = sum(gen_dict.values())
+            losses = total_supply - total_demand
+            if ledger is None:
+                payment_setup(step, auction_price, wrapper, supply, demand, price, agents, gen_dict, dlt, timer,
+                              submissions)
+                wrapper.mine_unconfirmed_transactions(timer)
+                times_vec.append(time.perf_counter()-start)
+            else:
+                with timer.stage('settlement'):
+                    settlement = _match_payments(step, auction_price, supply, demand, agents, gen_dict, dlt,
+                                                 submissions)
+                started[step] = start
+                ledger.submit(step, auction_price, settlement)
+            timer.end_step()
+        if ledger is not None:
+            ledger.close()
+            times_vec = [ledger.finished[step] - started[step] for step in steps_vec]
+        if isinstance(grid, PartitionedGrid):
+            grid.close()
+        if isinstance(engine, ProofOfWork):
+            engine.close()
+        if submissions is not None:
+            submissions.close()
+    if workspace is not None:
+        workspace.cleanup()
+    results_df = pd.DataFrame(data={'steps': [steps],
+                                    'agents': [num_agents],
+                                    'dlt': [dlt],
+                                    'mean': [np.mean(times_vec)],
+                                    'max': [np.max(times_vec)],
+                                    'min': [np.min(times_vec)]})
+    return results_df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dlt", help="Select DLT to test",
+                        type=str)
+    parser.add_argument("num_agents", help="Number of agents",
+                        type=int)
+    parser.add_argument("num_steps", help="Number of steps",
+                        type=int)
+    parser.add_argument("--solver", help="Power flow solver: ac, warm or dc",
+                        type=str, default='ac', choices=MicroGrid.solvers)
+    parser.add_argument("--topology", help="Layout of the grid, data reads lines.csv from --data",
+                        type=str, default='ring', choices=layouts)
+    parser.add_argument("--feeders", help="Feeders of the radial layout, clusters of the meshed one",
+                        type=int, default=1)
+    parser.add_argument("--feeder-workers", help="Processes solving the feeders of a step concurrently",
+                        type=int, default=1)
+    parser.add_argument("--pf-workers", help="Processes solving the power flow ahead of the ledger",
+                        type=int, default=1)
+    parser.add_argument("--mining-workers", help="Processes searching the proof of work nonce",
+                        type=int, default=1)
+    parser.add_argument("--chain-store", help="Directory persisting the mined blocks",
+                        type=str, default=None)
+    parser.add_argument("--address-pool", help="Directory keeping the generated agent addresses",
+                        type=str, default=None)
+    parser.add_argument("--seed", help="Seed of the synthetic data",
+                        type=int, default=None)
+    parser.add_argument("--data", help="Directory with a dataset or the demand, supply and price CSV files",
+                        type=str, default=None)
+    parser.add_argument("--consensus", help="Block sealing: pow, poa (signed by authorities) or none",
+                        type=str, default='pow', choices=engines)
+    parser.add_argument("--authorities", help="Number of agents sealing blocks under poa",
+                        type=int, default=1)
+    parser.add_argument("--block-size", help="Transactions per block, a step is cut into as many blocks as needed",
+                        type=int, default=None)
+    parser.add_argument("--block-bytes", help="Bytes per block",
+                        type=int, default=None)
+    parser.add_argument("--mempool-size", help="Pending transactions kept, further ones are dropped",
+                        type=int, default=None)
+    parser.add_argument("--mempool-order", help="Order in which pending transactions are mined",
+                        type=str, default='fifo', choices=Mempool.orders)
+    parser.add_argument("--fee-rate", help="Fee the agents offer per unit of payment, mined first under --mempool-order fee",
+                        type=float, default=0.0)
+    parser.add_argument("--submit-concurrency", help="IOTA bundles sent at the same time, 0 sends them one after another",
+                        type=int, default=8)
+    parser.add_argument("--pipeline-depth", help="Steps waiting for the ledger while the next ones run, 0 runs them in line",
+                        type=int, default=0)
+    parser.add_argument("--trace", help="File receiving the per step trace, JSON if it ends in .json else CSV",
+                        type=str, default=None)
+    parser.add_argument("--deviation", help="Compare every power flow with a flat start AC one and report the largest deviation",
+                        action='store_true')
+    parser.add_argument("--trace-memory", help="Record the memory of every step with tracemalloc",
+                        action='store_true')
+    parser.add_argument("--profile", help="File receiving a cProfile dump of the run",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    timer = None
+    if args.trace or args.trace_memory or args.profile or args.deviation:
+        timer = Trace(memory=args.trace_memory, profile=args.profile)
+    results_df = exec(args.dlt, args.num_agents, args.num_steps, args.solver, args.pf_workers,
+                      args.mining_workers, args.chain_store, args.address_pool, args.seed, timer,
+                      args.data, args.pipeline_depth, consensus=args.consensus,
+                      authorities=args.authorities, block_size=args.block_size,
+                      block_bytes=args.block_bytes, mempool_size=args.mempool_size,
+                      mempool_order=args.mempool_order, fee_rate=args.fee_rate, topology=args.topology,
+                      feeders=args.feeders, feeder_workers=args.feeder_workers,
+                      check_deviation=args.deviation, submit_concurrency=args.submit_concurrency)
+    print(results_df)
+    if args.deviation:
+        columns = ['deviation_p_mw', 'deviation_va_degree', 'deviation_vm_pu']
+        print(timer.to_frame()[columns].max().to_string())
+    if args.trace:
+        timer.save(args.trace)
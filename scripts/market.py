@@ -0,0 +1,60 @@
+# Market - vectorized single sided auction
+
+import numpy as np
+
+
+def clear_market(demand, supply, price):
+    """ Clear the single sided auction for one step or a block of steps.
+
+    Supply offers are merit ordered by price along the agent axis, the
+    cumulative supply is compared against the total demand of the step and
+    the first offer that covers it sets the clearing price. Gives the same
+    price as single_sided_auction in main.py.
+
+    Args:
+        demand (np.ndarray): demand per agent, shape (agents,) or (agents, steps)
+        supply (np.ndarray): supply offer per agent, same shape as demand
+        price (np.ndarray): offer price per agent, same shape as demand
+
+    Returns:
+        clearing_price (np.ndarray): clearing price per step, shape (steps,)
+        marginal_agent (np.ndarray): agent setting the price per step, shape (steps,)
+        dispatch (np.ndarray): dispatched supply per agent, same shape as demand
+    """
+    demand = np.asarray(demand, dtype=float)
+    supply = np.asarray(supply, dtype=float)
+    price = np.asarray(price, dtype=float)
+    single_step = demand.ndim == 1
+    if single_step:
+        demand = demand[:, np.newaxis]
+        supply = supply[:, np.newaxis]
+        price = price[:, np.newaxis]
+
+    num_agents, num_steps = demand.shape
+    total_demand = demand.sum(axis=0)
+
+    order = np.argsort(price, axis=0, kind='stable')
+    sorted_supply = np.take_along_axis(supply, order, axis=0)
+    cum_supply = np.cumsum(sorted_supply, axis=0)
+
+    position = np.empty(num_steps, dtype=np.intp)
+    for step in range(num_steps):
+        position[step] = np.searchsorted(cum_supply[:, step], total_demand[step], side='left')
+    # If supply never covers demand the most expensive offer sets the price
+    np.minimum(position, num_agents - 1, out=position)
+
+    steps = np.arange(num_steps)
+    marginal_agent = order[position, steps]
+    clearing_price = price[marginal_agent, steps]
+
+    # Offers below the marginal one are fully dispatched, the marginal one
+    # only covers what is left of the demand.
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(num_agents)[:, np.newaxis], axis=0)
+    dispatch = np.where(rank < position, supply, 0.0)
+    previous = np.where(position > 0, cum_supply[np.maximum(position - 1, 0), steps], 0.0)
+    dispatch[marginal_agent, steps] = np.clip(total_demand - previous, 0.0, supply[marginal_agent, steps])
+
+    if single_step:
+        dispatch = dispatch[:, 0]
+    return clearing_price, marginal_agent, dispatch
@@ -0,0 +1,175 @@
+# Mempool - bounded pool of pending transactions cut into blocks
+
+import numpy as np
+
+from transactions import TransactionStore
+
+# Bytes of a transaction in the columnar layout: author and seller ids,
+# payment and timestamp
+row_bytes = 4 + 4 + 8 + 8
+# Pending rows popped before the consumed head of the columns is dropped
+_shift_rows = 4096
+
+
+class Mempool:
+    orders = ('fifo', 'fee')
+
+    def __init__(self, max_transactions=None, max_bytes=None, block_transactions=None,
+                 block_bytes=None, order='fifo', book=None):
+        """ Pending transactions, with bounded size and size limited blocks.
+
+        Transactions are appended to TransactionStore columns and popped
+        from a moving head, so both are amortized O(1) per transaction in
+        FIFO order. With fee order a batch takes the highest fees, oldest
+        first among equal fees. The pool is ranked once and the blocks are
+        cut from that ranking until new transactions arrive, and a pool
+        with equal fees is cut in FIFO order without ranking. Sizes in
+        bytes use the columnar row size.
+
+        Args:
+            max_transactions (int): transactions the pool holds, unbounded if None
+            max_bytes (int): bytes the pool holds, unbounded if None
+            block_transactions (int): transactions per block, unbounded if None
+            block_bytes (int): bytes per block, unbounded if None
+            order (str): 'fifo' or 'fee'
+            book (AddressBook): address interning, the process one if None
+        """
+        if order not in self.orders:
+            raise ValueError("Unknown order {}, expected one of {}".format(order, self.orders))
+        self.capacity = _limit(max_transactions, max_bytes)
+        self.block_size = _limit(block_transactions, block_bytes)
+        if self.block_size == 0:
+            raise ValueError("Blocks must hold at least one transaction")
+        self.order = order
+        self.store = TransactionStore(book=book)
+        self.book = self.store.book
+        self.fees = np.zeros(len(self.store.payment))
+        self.head = 0
+        self.dropped = 0
+        # Pending rows in fee order, blocks are cut from position _cut on
+        self._ranked = None
+        self._cut = 0
+
+    def __len__(self):
+        if self._ranked is not None:
+            return len(self._ranked) - self._cut
+        return self.store.size - self.head
+
+    def __iter__(self):
+        self._settle()
+        for index in range(self.head, self.store.size):
+            yield self.store[index]
+
+    def free(self):
+        return self.capacity - len(self) if self.capacity is not None else None
+
+    def _admit(self, count):
+        """ Number of the next count transactions the pool has room for. """
+        free = self.free()
+        accepted = count if free is None else max(min(count, free), 0)
+        self.dropped += count - accepted
+        return accepted
+
+    def _set_fees(self, start, fees):
+        if len(self.fees) < len(self.store.payment):
+            grown = np.zeros(len(self.store.payment))
+            grown[:len(self.fees)] = self.fees
+            self.fees = grown
+        self.fees[start:self.store.size] = fees
+
+    def _settle(self):
+        """ Drop the rows cut from a fee ranking, keeping arrival order. """
+        if self._ranked is not None:
+            self._keep(np.sort(self._ranked[self._cut:]))
+            self._ranked = None
+
+    def append_dict(self, tx_data, fee=0.0):
+        self._settle()
+        if not self._admit(1):
+            return 0
+        self.store.append_dict(tx_data)
+        self._set_fees(self.store.size - 1, fee)
+        return 1
+
+    def extend(self, author, payments, sellers, timestamp, fees=0.0):
+        """ Append the payments of one author, see TransactionStore.extend.
+
+        Returns:
+            accepted (int): transactions admitted, the first ones given
+        """
+        self._settle()
+        accepted = self._admit(len(payments))
+        start = self.store.size
+        self.store.extend(author, payments[:accepted], sellers[:accepted], timestamp)
+        self._set_fees(start, fees if np.isscalar(fees) else fees[:accepted])
+        return accepted
+
+    def extend_ids(self, authors, sellers, payments, timestamp, fees=0.0):
+        """ Append payments with interned addresses, see TransactionStore.extend_ids.
+
+        Returns:
+            accepted (int): transactions admitted, the first ones given
+        """
+        self._settle()
+        accepted = self._admit(len(payments))
+        start = self.store.size
+        self.store.extend_ids(authors[:accepted], sellers[:accepted], payments[:accepted], timestamp)
+        self._set_fees(start, fees if np.isscalar(fees) else fees[:accepted])
+        return accepted
+
+    def pop_block(self):
+        """ Remove the transactions of the next block from the pool.
+
+        Returns:
+            transactions (TransactionStore): up to the block size, in pool order
+        """
+        count = len(self) if self.block_size is None else min(len(self), self.block_size)
+        if self.order == 'fee' and self._ranked is None and count:
+            fees = self.fees[self.head:self.store.size]
+            if fees.min() != fees.max():
+                # Highest fee first, stable so equal fees keep arrival order
+                self._ranked = self.head + np.argsort(-fees, kind='stable')
+                self._cut = 0
+        if self._ranked is not None:
+            block = self._take(self._ranked[self._cut:self._cut + count])
+            self._cut += count
+            if self._cut == len(self._ranked):
+                self._ranked = None
+                self.store.size = self.head = 0
+        else:
+            block = self._take(np.arange(self.head, self.head + count))
+            self.head += count
+            if self.head >= _shift_rows and self.head * 2 >= self.store.size:
+                self._keep(np.arange(self.head, self.store.size))
+        return block
+
+    def _take(self, rows):
+        block = TransactionStore(max(len(rows), 1), self.book)
+        for column in ('author', 'seller', 'payment', 'timestamp'):
+            getattr(block, column)[:len(rows)] = getattr(self.store, column)[rows]
+        block.size = len(rows)
+        return block
+
+    def _keep(self, rows):
+        """ Move rows to the start of the columns, dropping the others. """
+        for column in ('author', 'seller', 'payment', 'timestamp'):
+            values = getattr(self.store, column)
+            values[:len(rows)] = values[rows]
+        self.fees[:len(rows)] = self.fees[rows]
+        self.store.size = len(rows)
+        self.head = 0
+
+    def peek(self, limit=None):
+        """ Pending transactions as dicts, the first limit ones if given. """
+        self._settle()
+        stop = self.store.size if limit is None else min(self.store.size, self.head + limit)
+        return [self.store[index] for index in range(self.head, stop)]
+
+    def to_list(self):
+        return self.peek()
+
+
+def _limit(count, size):
+    """ Transactions allowed by a count and a byte limit, None if unbounded. """
+    limits = [limit for limit in (count, None if size is None else size // row_bytes) if limit is not None]
+    return min(limits) if limits else None
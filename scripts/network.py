@@ -0,0 +1,358 @@
+# Network - miner nodes in separate processes exchanging blocks
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import queue
+import random
+import time
+from hashlib import sha256
+
+import numpy as np
+import pandas as pd
+
+from addresses import provision_addresses
+from blockchain import Block, Blockchain, Wrapper
+from consensus import NoSeal, ProofOfAuthority, ProofOfWork, search_nonces
+from transactions import TransactionStore, address_book
+
+
+class MinerNode:
+    # Nonces tried between two checks of the inbox while mining
+    nonce_chunk = 2048
+
+    def __init__(self, node_id, inboxes, events, consensus, latency=0.05, jitter=0.0, seed=0):
+        """ One miner of the network, run in its own process by _run_node.
+
+        The node keeps its own Wrapper and chain. Messages from other nodes
+        are delivered latency (plus up to jitter) seconds after they were
+        sent, also while the node mines. Blocks extending the tip go through
+        verify_and_add_block, a block that does not link to the tip makes
+        the node ask its sender for the chain, which is replayed with
+        create_chain_from_dump and adopted when longer. Branches of the
+        same height are decided by the lower tip hash, so nodes that sealed
+        competing blocks for the same step all settle on one of them.
+
+        Under proof of work every node races for each block and stops when
+        a block of the same step reaches it first. Under proof of authority
+        and with no seal, the node at height modulo the number of nodes
+        seals the block, as in round robin authority schemes.
+
+        Args:
+            node_id (int): position of the node in inboxes
+            inboxes (list): message queue of every node
+            events (Queue): queue receiving the events measured by the node
+            consensus: engine sealing and verifying the blocks
+            latency (float): delay of every message in seconds
+            jitter (float): maximum random delay added to latency
+            seed (int): seed of the jitter
+        """
+        self.node_id = node_id
+        self.inboxes = inboxes
+        self.events = events
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed * 1000 + node_id)
+        self.wrapper = Wrapper(consensus=consensus)
+        self.delayed = []
+        self.sequence = 0
+        # Step settled by each known block, and the payments of each step
+        self.block_steps = {}
+        self.batches = {}
+        self.pending = []
+        self.running = True
+
+    @property
+    def chain(self):
+        return self.wrapper.blockchain.chain
+
+    def _event(self, kind, **fields):
+        fields.update(kind=kind, node=self.node_id, time=time.time())
+        self.events.put(fields)
+
+    def _send(self, node, message):
+        self.inboxes[node].put((time.time(), self.node_id, message))
+
+    def _broadcast(self, message):
+        for node in range(len(self.inboxes)):
+            if node != self.node_id:
+                self._send(node, message)
+
+    def run(self):
+        while self.running:
+            timeout = max(self.delayed[0][0] - time.time(), 0) if self.delayed else 0.01
+            self._receive(timeout)
+            self._deliver()
+            if self.pending and self.running and self._in_turn():
+                self._mine()
+
+    def _receive(self, timeout=0):
+        """ Move the messages of the inbox to the delivery queue. """
+        inbox = self.inboxes[self.node_id]
+        try:
+            item = inbox.get(timeout=timeout) if timeout else inbox.get_nowait()
+            while True:
+                sent, sender, message = item
+                if message[0] == 'stop':
+                    self._stop()
+                    return
+                # The driver is not a node, its messages arrive at once
+                delay = 0 if sender is None else self.latency + self.random.uniform(0, self.jitter)
+                self.sequence += 1
+                heapq.heappush(self.delayed, (sent + delay, self.sequence, sender, message))
+                item = inbox.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _deliver(self):
+        while self.delayed and self.delayed[0][0] <= time.time():
+            _, _, sender, message = heapq.heappop(self.delayed)
+            getattr(self, '_on_' + message[0])(sender, *message[1:])
+
+    def _in_turn(self):
+        if isinstance(self.wrapper.blockchain.consensus, ProofOfWork):
+            return True
+        return len(self.chain) % len(self.inboxes) == self.node_id
+
+    def _on_transactions(self, sender, step, authors, sellers, payments):
+        self.batches[step] = (authors, sellers, payments)
+        if step not in self._settled_steps():
+            self.pending.append(step)
+
+    def _settled_steps(self):
+        return {self.block_steps.get(block.hash) for block in self.chain}
+
+    def _mine(self):
+        """ Seal the oldest pending step on the tip, giving up if the tip moves. """
+        step = self.pending[0]
+        authors, sellers, payments = self.batches[step]
+        transactions = TransactionStore(len(payments))
+        transactions.extend_ids(address_book.intern_many(authors), address_book.intern_many(sellers),
+                                payments, time.time())
+        tip = self.chain[-1]
+        block = Block(tip.index + 1, transactions, time.time(), tip.hash)
+        consensus = self.wrapper.blockchain.consensus
+        if isinstance(consensus, ProofOfWork):
+            header = sha256(block.header_prefix())
+            start, found = 0, None
+            while found is None:
+                found = search_nonces(header, consensus.difficulty, start, start + self.nonce_chunk)
+                start += self.nonce_chunk
+                self._receive()
+                self._deliver()
+                if not self.running or self.chain[-1] is not tip or step not in self.pending:
+                    return
+            block.nonce, proof = found
+        else:
+            proof = consensus.seal(block)
+        self.wrapper.blockchain.add_block(block, proof)
+        self.block_steps[proof] = step
+        self.pending.remove(step)
+        self._event('mined', height=block.index, hash=proof, step=step, transactions=len(transactions))
+        self._broadcast(('block', block.to_dict(), step))
+
+    def _on_block(self, sender, block_data, step):
+        block_hash = block_data['hash']
+        self.block_steps[block_hash] = step
+        height = block_data['index']
+        if height < len(self.chain):
+            if self.chain[height].hash != block_hash:
+                self._event('fork', height=height, hash=block_hash, origin=sender)
+                if height == len(self.chain) - 1 and block_hash < self.chain[-1].hash:
+                    # A branch as long as ours with a lower tip wins the tie
+                    self._send(sender, ('chain_request',))
+            return
+        if height == len(self.chain) and block_data['previous_hash'] == self.chain[-1].hash:
+            message, status = self.wrapper.verify_and_add_block(block_data)
+            if status == 201:
+                self._event('accepted', height=height, hash=block_hash, origin=sender, step=step)
+                self._update_pending()
+            return
+        # The block extends a branch this node does not have
+        self._send(sender, ('chain_request',))
+
+    def _on_chain_request(self, sender):
+        self._send(sender, ('chain', json.loads(self.wrapper.get_chain())['chain']))
+
+    def _on_chain(self, sender, chain_dump):
+        if not self._preferred(chain_dump):
+            return
+        try:
+            generated = self.wrapper.create_chain_from_dump(chain_dump)
+        except Exception:
+            self._event('invalid_chain', origin=sender)
+            return
+        common = 0
+        while common < len(self.chain) and self.chain[common].hash == generated.chain[common].hash:
+            common += 1
+        depth = len(self.chain) - common
+        if common == len(generated.chain):
+            return
+        self.wrapper.blockchain.chain = generated.chain
+        self._event('reorg', height=len(generated.chain) - 1, depth=depth, origin=sender)
+        for block in generated.chain[common:]:
+            self._event('accepted', height=block.index, hash=block.hash, origin=sender,
+                        step=self.block_steps.get(block.hash))
+        self._update_pending()
+
+    def _preferred(self, chain_dump):
+        """ Longest chain first, then the lower tip hash. """
+        if len(chain_dump) != len(self.chain):
+            return len(chain_dump) > len(self.chain)
+        return chain_dump[-1]['hash'] < self.chain[-1].hash
+
+    def _update_pending(self):
+        """ Pending steps are the received ones not settled by the chain,
+        including the steps of blocks orphaned by a reorganization. """
+        settled = self._settled_steps()
+        self.pending = sorted(step for step in self.batches if step not in settled)
+
+    def _stop(self):
+        self._event('final', chain=[block.hash for block in self.chain])
+        self.running = False
+
+
+def _run_node(node_id, inboxes, events, consensus, latency, jitter, seed):
+    MinerNode(node_id, inboxes, events, consensus, latency, jitter, seed).run()
+
+
+def run_network(num_nodes=4, num_steps=10, transactions=100, interval=0.5, latency=0.05, jitter=0.0,
+                consensus='pow', difficulty=Blockchain.difficulty, confirmations=2, seed=0):
+    """ Run a network of miner processes over a stream of settlement steps.
+
+    Every interval seconds the payments of a step are sent to all nodes,
+    which seal them into one block and broadcast it. Competing blocks at
+    the same height are forks, resolved by the longer branch or, at equal
+    height, the lower tip hash.
+
+    Args:
+        num_nodes (int): miner processes
+        num_steps (int): settlement steps sent to the network
+        transactions (int): payments per step
+        interval (float): seconds between steps
+        latency (float): delay of every message between nodes in seconds
+        jitter (float): maximum random delay added to latency
+        consensus (str): 'pow', 'poa' (every node an authority) or 'none'
+        difficulty (int): difficulty of proof of work
+        confirmations (int): blocks on top of a step's block for it to be final
+        seed (int): seed of the payments and the jitter
+
+    Returns:
+        metrics (dict): fork rate, propagation delay and finality statistics
+        events (pd.DataFrame): every event reported by the nodes
+    """
+    keys = provision_addresses(max(num_nodes, 2) * 2, seed=seed)
+    context = multiprocessing.get_context()
+    inboxes = [context.Queue() for _ in range(num_nodes)]
+    events = context.Queue()
+    nodes = []
+    for node_id in range(num_nodes):
+        if consensus == 'poa':
+            engine = ProofOfAuthority(keys[:num_nodes], signer=keys[node_id])
+        elif consensus == 'none':
+            engine = NoSeal()
+        else:
+            engine = ProofOfWork(difficulty)
+        process = context.Process(target=_run_node, daemon=True,
+                                  args=(node_id, inboxes, events, engine, latency, jitter, seed))
+        process.start()
+        nodes.append(process)
+
+    random_state = np.random.RandomState(seed)
+    submitted = {}
+    for step in range(num_steps):
+        authors = [keys[i] for i in random_state.randint(len(keys), size=transactions)]
+        sellers = [keys[i] for i in random_state.randint(len(keys), size=transactions)]
+        payments = random_state.uniform(1, 100, size=transactions)
+        submitted[step] = time.time()
+        for inbox in inboxes:
+            inbox.put((submitted[step], None, ('transactions', step, authors, sellers, payments)))
+        time.sleep(interval)
+    # Let the last blocks propagate before stopping
+    time.sleep(max(interval, 4 * (latency + jitter)))
+    for inbox in inboxes:
+        inbox.put((time.time(), None, ('stop',)))
+
+    collected = []
+    finals = 0
+    while finals < num_nodes:
+        try:
+            event = events.get(timeout=1)
+        except queue.Empty:
+            crashed = [process.exitcode for process in nodes if process.exitcode not in (None, 0)]
+            if crashed:
+                for process in nodes:
+                    process.terminate()
+                raise RuntimeError("Miner node exited with code {}".format(crashed[0]))
+            continue
+        finals += event['kind'] == 'final'
+        collected.append(event)
+    for process in nodes:
+        process.join()
+    return _metrics(collected, submitted, num_nodes, confirmations), pd.DataFrame(collected)
+
+
+def _metrics(events, submitted, num_nodes, confirmations):
+    finals = [event['chain'] for event in events if event['kind'] == 'final']
+    canonical = max(finals, key=len)
+    on_chain = set(canonical)
+    mined = {event['hash']: event for event in events if event['kind'] == 'mined'}
+    orphaned = [block_hash for block_hash in mined if block_hash not in on_chain]
+    # First time each node held each block, by mining it or accepting it
+    held = {}
+    for event in events:
+        if event['kind'] in ('mined', 'accepted'):
+            held.setdefault((event['node'], event['hash']), event['time'])
+    delays = [held_at - mined[block_hash]['time'] for (node, block_hash), held_at in held.items()
+              if block_hash in mined and mined[block_hash]['node'] != node]
+
+    finality = []
+    for height, block_hash in enumerate(canonical):
+        if block_hash not in mined or height + confirmations >= len(canonical):
+            continue
+        burying = canonical[height + confirmations]
+        times = [held.get((node, burying)) for node in range(num_nodes)]
+        if None not in times:
+            finality.append(max(times) - submitted[mined[block_hash]['step']])
+
+    return {'nodes': num_nodes,
+            'height': len(canonical) - 1,
+            'blocks_mined': len(mined),
+            'fork_rate': len(orphaned) / len(mined) if mined else 0.0,
+            'forks_seen': sum(event['kind'] == 'fork' for event in events),
+            'reorgs': sum(event['kind'] == 'reorg' for event in events),
+            'converged': all(final == canonical for final in finals),
+            'propagation_mean': float(np.mean(delays)) if delays else np.nan,
+            'propagation_p95': float(np.percentile(delays, 95)) if delays else np.nan,
+            'finality_mean': float(np.mean(finality)) if finality else np.nan,
+            'finality_max': float(np.max(finality)) if finality else np.nan}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", help="Miner processes", type=int, default=4)
+    parser.add_argument("--steps", help="Settlement steps sent to the network", type=int, default=10)
+    parser.add_argument("--transactions", help="Payments per step", type=int, default=100)
+    parser.add_argument("--interval", help="Seconds between steps", type=float, default=0.5)
+    parser.add_argument("--latency", help="Delay of every message between nodes in seconds",
+                        type=float, default=0.05)
+    parser.add_argument("--jitter", help="Maximum random delay added to the latency",
+                        type=float, default=0.0)
+    parser.add_argument("--consensus", help="Block sealing of the nodes", type=str, default='pow',
+                        choices=('pow', 'poa', 'none'))
+    parser.add_argument("--difficulty", help="Difficulty of proof of work", type=int,
+                        default=Blockchain.difficulty)
+    parser.add_argument("--confirmations", help="Blocks on top of a step's block for it to be final",
+                        type=int, default=2)
+    parser.add_argument("--seed", help="Seed of the payments and the jitter", type=int, default=0)
+    parser.add_argument("--events", help="CSV file receiving every event of the nodes",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    metrics, events = run_network(args.nodes, args.steps, args.transactions, args.interval, args.latency,
+                                  args.jitter, args.consensus, args.difficulty, args.confirmations,
+                                  args.seed)
+    if args.events:
+        events.drop(columns=['chain'], errors='ignore').to_csv(args.events, index=False)
+    print(json.dumps(metrics, indent=1))
@@ -0,0 +1,60 @@
+# Pipeline - ledger work of a step overlapped with the next steps
+
+import queue
+import threading
+from time import perf_counter
+
+
+class LedgerWorker:
+    def __init__(self, handler, depth=2):
+        """ Runs the ledger stage of every step on its own thread.
+
+        Steps are handed over through a bounded queue and handled one at a
+        time in submission order, so blocks are mined in step order whatever
+        the front stages do. submit blocks once depth steps are waiting,
+        which bounds the memory held by steps not yet on the ledger.
+
+        Only the worker thread may use the ledger while it runs. The proof of
+        work holds the GIL when searched in the thread itself, so the
+        overlap with the power flow is largest with mining workers.
+
+        Args:
+            handler (callable): handler(step, *args) doing the ledger work
+            depth (int): maximum number of steps waiting for the worker
+        """
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.finished = {}
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='ledger', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Keep draining so submit never blocks after a failure
+                continue
+            step, args = item
+            try:
+                self.handler(step, *args)
+                self.finished[step] = perf_counter()
+            except BaseException as error:
+                self.error = error
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, step, *args):
+        """ Queue the ledger work of a step, waiting while the queue is full. """
+        self._check()
+        self.queue.put((step, args))
+
+    def close(self):
+        """ Wait for the queued steps and raise the error of a failed one. """
+        self.queue.put(None)
+        self._thread.join()
+        self._check()
@@ -0,0 +1,187 @@
+# Population - the agents of a run stored as columns
+
+import numpy as np
+
+from transactions import address_book
+
+
+class AgentPopulation:
+    def __init__(self, demand, supply, price, addresses, nodes=None, wrapper=None, fee_rate=0.0):
+        """ All agents as a structure of arrays.
+
+        The series are kept as given, so memory mapped datasets are not
+        loaded, and a step of every agent is one row. Per agent objects are
+        only built on demand, as AgentView.
+
+        Args:
+            demand (np.ndarray): demand per step (rows) and agent (columns)
+            supply (np.ndarray): supply per step (rows) and agent (columns)
+            price (np.ndarray): offer price per step (rows) and agent (columns)
+            addresses (list): address of every agent
+            nodes (np.ndarray): node of every agent, its position if None
+            wrapper (Wrapper): blockchain node the agents register with as peers
+            fee_rate (float): fee offered per unit of payment
+        """
+        self.demand = demand
+        self.supply = supply
+        self.price = price
+        self.addresses = list(addresses)
+        self.address_ids = address_book.intern_many(self.addresses)
+        self.nodes = np.arange(len(self.addresses)) if nodes is None else np.asarray(nodes)
+        self.fee_rate = fee_rate
+        self.settlement = None
+        self.auction_price = None
+        self._payment_data = {}
+        if wrapper is not None:
+            wrapper.register_peers(self.addresses)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("agent index out of range")
+        return AgentView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield AgentView(self, index)
+
+    def energy_info(self, step):
+        """ Energy info of every agent for a step.
+
+        The columns of publish_energy_info for all agents at once. They are
+        views of the series except consumption, computed for the step.
+        """
+        demand = self.demand[step]
+        supply = self.supply[step]
+        return {'node': self.nodes,
+                'demand': demand,
+                'supply': supply,
+                'consumption': demand - supply,
+                'price': self.price[step]}
+
+    def set_payment_data(self, settlement, auction_price):
+        """ Payments of the step, replacing any set on single agents.
+
+        Args:
+            settlement (Settlement): payments of the step in CSR layout
+            auction_price (float): clearing price of the step
+        """
+        self.settlement = settlement
+        self.auction_price = auction_price
+        self._payment_data = {}
+
+    def payment_data(self, index):
+        """ Payment data of one agent in the dict layout of Agent.set_payment_data. """
+        data = self._payment_data.get(index)
+        if data is not None:
+            return data
+        settlement = self.settlement
+        position = np.searchsorted(settlement.payers, index)
+        if position == len(settlement.payers) or settlement.payers[position] != index:
+            start = end = 0
+        else:
+            start, end = settlement.offsets[position], settlement.offsets[position + 1]
+        earners = settlement.earners[start:end]
+        return {'price': self.auction_price,
+                'node': earners,
+                'power': settlement.amounts[start:end],
+                'seller': [self.addresses[earner] for earner in earners]}
+
+    def pay_power(self, step, wrapper):
+        """ Send the payments of every payer of the step in one batch.
+
+        Args:
+            step (int): step running at the moment
+            wrapper (Wrapper): blockchain node receiving the transactions
+        """
+        settlement = self.settlement
+        authors = np.repeat(self.address_ids[settlement.payers], np.diff(settlement.offsets))
+        sellers = self.address_ids[settlement.earners]
+        payments = self.auction_price * settlement.amounts
+        # Agents given their own payment data pay it instead of their row
+        keep = ~np.isin(authors, self.address_ids[list(self._payment_data)])
+        wrapper.new_payment_batch(authors[keep], sellers[keep], payments[keep], self.fee_rate * payments[keep])
+        for index in self._payment_data:
+            self[index].pay_power(step, wrapper)
+
+
+class AgentView:
+    def __init__(self, population, index):
+        """ One agent of a population, with the API of blockchain.Agent.
+
+        Args:
+            population (AgentPopulation): population holding the agent
+            index (int): position of the agent in the population
+        """
+        self.population = population
+        self.index = index
+
+    @property
+    def demand(self):
+        return self.population.demand[:, self.index]
+
+    @property
+    def supply(self):
+        return self.population.supply[:, self.index]
+
+    @property
+    def price(self):
+        return self.population.price[:, self.index]
+
+    @property
+    def node(self):
+        return self.population.nodes[self.index]
+
+    @property
+    def address(self):
+        return self.population.addresses[self.index]
+
+    @property
+    def payment_data(self):
+        return self.population.payment_data(self.index)
+
+    def publish_energy_info(self, step):
+        agents_info = {}
+        agents_info['node'] = self.node
+        agents_info['demand'] = self.demand[step]
+        agents_info['supply'] = self.supply[step]
+        agents_info['consumption'] = self.demand[step] - self.supply[step]
+        agents_info['price'] = self.price[step]
+
+        return self.node, agents_info
+
+    def get_demand(self):
+        return self.demand
+
+    def get_supply(self):
+        return self.supply
+
+    def get_node(self):
+        return self.node
+
+    def get_address(self):
+        return self.address
+
+    def get_consumption(self):
+        return self.demand - self.supply
+
+    def get_prices(self):
+        return self.price
+
+    def set_payment_data(self, data):
+        self.population._payment_data[self.index] = data
+
+    def pay_power(self, step, wrapper):
+        """ Send power payment
+
+        Args:
+            step (float): step running at the moment.
+        """
+        unpack_data = self.payment_data
+        payments = unpack_data['price'] * np.asarray(unpack_data['power'])
+        wrapper.new_transactions(self.address, payments, unpack_data['seller'],
+                                 self.population.fee_rate * payments)
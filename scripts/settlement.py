@@ -0,0 +1,51 @@
+# Settlement - match payers and earners of a step
+
+from collections import namedtuple
+
+import numpy as np
+
+# Payments of a step in CSR layout: the payments of payers[i] are
+# earners[offsets[i]:offsets[i+1]] with amounts[offsets[i]:offsets[i+1]]
+Settlement = namedtuple('Settlement', ['payers', 'offsets', 'earners', 'amounts'])
+
+
+def settle_payments(balance, tolerance=0.00001):
+    """ Greedy matching of agents with a deficit to agents with a surplus.
+
+    Payers are served in node order and each one takes power from the
+    earners in node order until its deficit is covered, the same greedy
+    allocation the nested loop in payment_setup used to build. Instead of walking
+    both lists, the cumulative payer and earner balances are merged: every
+    breakpoint of either cumulative sum starts a new (payer, earner) segment
+    and the segment length is the amount paid. Segments left by rounding
+    noise of the cumulative sums are dropped.
+
+    Args:
+        balance (np.ndarray): supply minus demand of every agent. Balances
+            smaller than tolerance in absolute value are ignored.
+        tolerance (float): threshold under which a balance counts as zero
+
+    Returns:
+        settlement (Settlement): payments of the step in CSR layout
+    """
+    balance = np.asarray(balance, dtype=float)
+    payers = np.flatnonzero(balance <= -tolerance)
+    earners = np.flatnonzero(balance >= tolerance)
+    cum_pay = np.cumsum(-balance[payers])
+    cum_earn = np.cumsum(balance[earners])
+
+    total = min(cum_pay[-1] if len(payers) else 0.0, cum_earn[-1] if len(earners) else 0.0)
+    breakpoints = np.union1d(cum_pay, cum_earn)
+    breakpoints = np.append(breakpoints[breakpoints < total], total) if total > 0 else np.empty(0)
+    starts = np.concatenate(([0.0], breakpoints[:-1]))[:len(breakpoints)]
+    amounts = breakpoints - starts
+    # Nearly equal breakpoints of both sums leave rounding noise segments
+    keep = amounts > tolerance * 1e-3
+    starts = starts[keep]
+    amounts = amounts[keep]
+
+    payer_pos = np.searchsorted(cum_pay, starts, side='right')
+    earner_pos = np.searchsorted(cum_earn, starts, side='right')
+    offsets = np.searchsorted(payer_pos, np.arange(len(payers) + 1), side='left')
+
+    return Settlement(payers, offsets, earners[earner_pos], amounts)
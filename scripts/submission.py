@@ -0,0 +1,113 @@
+# Submission - asyncio pipeline for IOTA transactions
+
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import iota
+from tangle import ProposedTransaction, Address, Tag, TryteString
+
+
+class SubmissionPipeline:
+    def __init__(self, concurrency=8, node_factory=None, depth=3, min_weight_magnitude=9):
+        """ Bounded concurrent submission of zero value transactions.
+
+        At most concurrency bundles are prepared and sent at the same time,
+        each on a worker thread. A worker keeps the node it got from
+        node_factory for all its submissions, so connections are reused
+        instead of opened per message. Submissions are grouped by event
+        loop and barrier waits for all of the current one, so every step
+        can run its own loop, also on several threads at once.
+
+        Args:
+            concurrency (int): bundles in flight at the same time
+            node_factory (callable): returns the node of a worker thread.
+                All workers share iota.api if None.
+            depth (int): depth given to send_trytes
+            min_weight_magnitude (int): proof of work given to send_trytes
+        """
+        self.concurrency = concurrency
+        self.node_factory = node_factory
+        self.depth = depth
+        self.min_weight_magnitude = min_weight_magnitude
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._local = threading.local()
+        # Semaphore and scheduled tasks of every running loop
+        self._semaphores = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _node(self):
+        if self.node_factory is None:
+            return iota.api
+        node = getattr(self._local, 'node', None)
+        if node is None:
+            node = self._local.node = self.node_factory()
+        return node
+
+    def _send(self, messages, tag):
+        node = self._node()
+        transfers = [ProposedTransaction(
+            address = Address(address),
+            message = TryteString.from_unicode(json.dumps(data)),
+            tag = Tag(tag),
+            value = 0) for data, address in messages]
+        tx = node.prepare_transfer(transfers=transfers)
+        return node.send_trytes(tx['trytes'], depth=self.depth,
+                                min_weight_magnitude=self.min_weight_magnitude)
+
+    async def submit(self, messages, tag='INFO'):
+        """ Send messages as one bundle once a slot is free.
+
+        Args:
+            messages (list): (data, address) pairs of the bundle
+            tag (str): tag of the transactions
+        """
+        loop = asyncio.get_running_loop()
+        # A semaphore is bound to the loop it is first used in, e.g. the one
+        # asyncio.run starts for a step
+        with self._lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, self._send, messages, tag)
+
+    def schedule(self, messages, tag='INFO'):
+        """ Start a submission of the current step without waiting for it. """
+        task = asyncio.ensure_future(self.submit(messages, tag))
+        with self._lock:
+            self._pending.setdefault(asyncio.get_running_loop(), []).append(task)
+        return task
+
+    async def barrier(self):
+        """ Wait for every submission of the step, in scheduling order.
+
+        Returns:
+            results (list): send_trytes result of every submission
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            pending = self._pending.pop(loop, [])
+        try:
+            return await asyncio.gather(*pending)
+        finally:
+            with self._lock:
+                self._semaphores.pop(loop, None)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+async def publish_step(pipeline, messages, tag='INFO'):
+    """ Submit the bundles of all agents for a step and wait for them.
+
+    Args:
+        pipeline (SubmissionPipeline): pipeline sending the bundles
+        messages (list): one list of (data, address) pairs per bundle
+        tag (str): tag of the transactions
+    """
+    for bundle in messages:
+        pipeline.schedule(bundle, tag)
+    return await pipeline.barrier()
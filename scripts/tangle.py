@@ -0,0 +1,329 @@
+# Tangle - local in-process stand-in for an IOTA node
+
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+# Trytes are written with this alphabet, '9' is the zero tryte
+ALPHABET = '9ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_values = {tryte: value for value, tryte in enumerate(ALPHABET)}
+
+# Field sizes in trytes of a serialized transaction, 2673 trytes in total
+_layout = [('signature_message_fragment', 2187), ('address', 81), ('value', 27),
+           ('legacy_tag', 27), ('timestamp', 9), ('current_index', 9), ('last_index', 9),
+           ('bundle_hash', 81), ('trunk_transaction_hash', 81),
+           ('branch_transaction_hash', 81), ('tag', 27), ('attachment_timestamp', 9),
+           ('attachment_timestamp_lower_bound', 9), ('attachment_timestamp_upper_bound', 9),
+           ('nonce', 27)]
+_int_fields = {'value', 'timestamp', 'current_index', 'last_index', 'attachment_timestamp',
+               'attachment_timestamp_lower_bound', 'attachment_timestamp_upper_bound', 'nonce'}
+_fragment_length = 2187
+# Messages are split on whole bytes, two trytes each, one tryte of every
+# fragment is left as padding
+_message_length = _fragment_length - 1
+_hash_length = 81
+
+
+def _int_to_trytes(value, length):
+    """ Unsigned integer as a fixed number of trytes, most significant first. """
+    if value < 0:
+        raise ValueError("Only zero value transfers are supported")
+    trytes = []
+    for _ in range(length):
+        value, digit = divmod(value, 27)
+        trytes.append(ALPHABET[digit])
+    return ''.join(reversed(trytes))
+
+
+def _trytes_to_int(trytes):
+    value = 0
+    for tryte in trytes:
+        value = value * 27 + _values[tryte]
+    return value
+
+
+def _hash_trytes(digest):
+    """ 81 tryte hash of a sha256 digest. Zero trailing trits of the digest
+    number show up as trailing 9s, as in IOTA hashes. """
+    return _int_to_trytes(int.from_bytes(digest, 'big'), _hash_length)
+
+
+def _search_nonce(trytes, min_weight_magnitude):
+    """ Smallest nonce giving a hash with min_weight_magnitude zero trailing trits.
+
+    Args:
+        trytes (str): transaction trytes, the nonce field is replaced
+        min_weight_magnitude (int): number of zero trailing trits
+    """
+    nonce_length = _layout[-1][1]
+    prefix = sha256(trytes[:-nonce_length].encode())
+    target = 3 ** min_weight_magnitude
+    nonce = 0
+    while True:
+        attempt = prefix.copy()
+        attempt.update(_int_to_trytes(nonce, nonce_length).encode())
+        if int.from_bytes(attempt.digest(), 'big') % target == 0:
+            return nonce
+        nonce += 1
+
+
+def join_fragments(fragments):
+    """ Message spread over the signature fragments of a transfer, in order. """
+    return TryteString(''.join(str(fragment)[:_message_length] for fragment in fragments))
+
+
+class TryteString(str):
+    """ Tryte encoded string, with the codec of PyOTA's TryteString. """
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(''.join(ALPHABET[byte % 27] + ALPHABET[byte // 27] for byte in data))
+
+    @classmethod
+    def from_unicode(cls, text):
+        return cls.from_bytes(text.encode('utf-8'))
+
+    def as_bytes(self, strip_padding=True, errors='strict'):
+        """ Bytes encoded by the trytes, two trytes per byte.
+
+        Args:
+            strip_padding (bool): drop the trailing 9s
+            errors (str): 'strict' raises on tryte pairs that are not a
+                byte, any other value skips them
+        """
+        trytes = str(self)
+        if strip_padding:
+            trytes = trytes.rstrip('9')
+            trytes += '9' * (len(trytes) % 2)
+        values = [_values[trytes[i]] + 27 * _values[trytes[i + 1]] for i in range(0, len(trytes) - 1, 2)]
+        if errors == 'strict':
+            return bytes(values)
+        return bytes(value for value in values if value < 256)
+
+    def decode(self, errors='strict', strip_padding=True):
+        return self.as_bytes(strip_padding, errors).decode('utf-8', errors)
+
+
+class Address(TryteString):
+    def __new__(cls, trytes):
+        return super().__new__(cls, str(trytes)[:_hash_length].ljust(_hash_length, '9'))
+
+
+class Tag(TryteString):
+    def __new__(cls, trytes):
+        return super().__new__(cls, str(trytes)[:27].ljust(27, '9'))
+
+
+class ProposedTransaction:
+    def __init__(self, address, value=0, tag=None, message=None, timestamp=None):
+        """ Transfer to be bundled by prepare_transfer.
+
+        Args:
+            address (Address): receiving address
+            value (int): transferred value, only zero value is supported
+            tag (Tag): tag of the transfer
+            message (TryteString): message, split over several transactions
+                when longer than a signature fragment
+            timestamp (int): creation time, the logical clock of the node
+                preparing the transfer if None
+        """
+        if value != 0:
+            raise ValueError("Only zero value transfers are supported")
+        self.address = Address(address)
+        self.value = value
+        self.tag = Tag(tag or '')
+        self.message = TryteString(message or '')
+        self.timestamp = timestamp
+
+
+class Transaction:
+    def __init__(self, **fields):
+        """ Transaction of the tangle, read from its tryte string. """
+        for name, length in _layout:
+            setattr(self, name, fields.get(name, 0 if name in _int_fields else TryteString('9' * length)))
+        self.hash = fields.get('hash')
+
+    @classmethod
+    def from_tryte_string(cls, trytes):
+        fields = {}
+        position = 0
+        for name, length in _layout:
+            value = str(trytes)[position:position + length]
+            position += length
+            if name in _int_fields:
+                fields[name] = _trytes_to_int(value)
+            elif name == 'address':
+                fields[name] = Address(value)
+            elif name in ('tag', 'legacy_tag'):
+                fields[name] = Tag(value)
+            else:
+                fields[name] = TryteString(value)
+        fields['hash'] = _hash_trytes(sha256(str(trytes).encode()).digest())
+        return cls(**fields)
+
+    def as_tryte_string(self):
+        parts = []
+        for name, length in _layout:
+            value = getattr(self, name)
+            parts.append(_int_to_trytes(value, length) if name in _int_fields else str(value).ljust(length, '9'))
+        return TryteString(''.join(parts))
+
+
+class LocalTangle:
+    def __init__(self, min_weight_magnitude=None, seed=0, pow_workers=None):
+        """ In-process DAG ledger with the API used by the IOTA agents.
+
+        Transactions are kept with an address index and a tag index, tips
+        are picked uniformly at random among the unapproved transactions and
+        every attached transaction carries a proof of work: its hash must
+        end in min_weight_magnitude zero trits. The ledger can be used from
+        several threads, only the proof of work runs outside its lock.
+
+        Args:
+            min_weight_magnitude (int): proof of work required for every
+                attachment. The one requested by send_trytes is used if None.
+            seed (int): seed of tip selection and address generation
+            pow_workers (int): processes doing the proof of work of concurrent
+                submissions. It runs in the calling thread if None.
+        """
+        self._lock = threading.RLock()
+        self._pow_pool = ProcessPoolExecutor(pow_workers) if pow_workers else None
+        self.min_weight_magnitude = min_weight_magnitude
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.transactions = {}
+        self.addresses = {}
+        self.tags = {}
+        self.bundles = {}
+        genesis = Transaction(hash='9' * _hash_length)
+        self.transactions[genesis.hash] = genesis.as_tryte_string()
+        self.tips = [genesis.hash]
+        self._tip_positions = {genesis.hash: 0}
+        # Logical clock of bundles and attachments, keeps hashes reproducible between runs
+        self._clock = 0
+
+    def get_new_addresses(self, index=0, count=1):
+        addresses = [Address(_hash_trytes(sha256('{}:{}'.format(self.seed, i).encode()).digest()))
+                     for i in range(index, index + count)]
+        return {'addresses': addresses}
+
+    def prepare_transfer(self, transfers, inputs=None, change_address=None):
+        """ Bundle zero value transfers, splitting long messages. """
+        with self._lock:
+            self._clock += 1
+            clock = self._clock
+        transactions = []
+        for transfer in transfers:
+            timestamp = clock if transfer.timestamp is None else transfer.timestamp
+            message = str(transfer.message) or '9'
+            for start in range(0, len(message), _message_length):
+                transactions.append(Transaction(
+                    signature_message_fragment=TryteString(message[start:start + _message_length]),
+                    address=transfer.address, value=transfer.value, legacy_tag=transfer.tag,
+                    tag=transfer.tag, timestamp=timestamp))
+
+        essence = sha256()
+        for index, tx in enumerate(transactions):
+            tx.current_index = index
+            tx.last_index = len(transactions) - 1
+            essence.update('{}{}{}{}{}'.format(tx.address, tx.value, tx.tag, tx.timestamp, index).encode())
+        bundle_hash = TryteString(_hash_trytes(essence.digest()))
+        for tx in transactions:
+            tx.bundle_hash = bundle_hash
+        return {'trytes': [tx.as_tryte_string() for tx in transactions]}
+
+    def get_transactions_to_approve(self, depth=3):
+        """ Uniform random tip selection. """
+        with self._lock:
+            trunk = self.random.choice(self.tips)
+            branch = self.random.choice(self.tips)
+        return {'trunkTransaction': trunk, 'branchTransaction': branch}
+
+    def attach_to_tangle(self, trunk, branch, trytes, min_weight_magnitude):
+        """ Chain the bundle on the selected tips and do its proof of work.
+
+        The last transaction of the bundle approves both tips and every
+        other transaction approves the next one of its bundle.
+        """
+        transactions = sorted((Transaction.from_tryte_string(tx) for tx in trytes),
+                              key=lambda tx: tx.current_index)
+        attached = []
+        previous = None
+        for tx in reversed(transactions):
+            tx.trunk_transaction_hash = TryteString(previous or trunk)
+            tx.branch_transaction_hash = TryteString(branch if previous is None else trunk)
+            with self._lock:
+                self._clock += 1
+                tx.attachment_timestamp = self._clock
+            tx.nonce = self._proof_of_work(tx, min_weight_magnitude)
+            tx_trytes = tx.as_tryte_string()
+            previous = Transaction.from_tryte_string(tx_trytes).hash
+            attached.append(tx_trytes)
+        return {'trytes': list(reversed(attached))}
+
+    def _proof_of_work(self, tx, min_weight_magnitude):
+        trytes = str(tx.as_tryte_string())
+        if self._pow_pool is None:
+            return _search_nonce(trytes, min_weight_magnitude)
+        return self._pow_pool.submit(_search_nonce, trytes, min_weight_magnitude).result()
+
+    def store_transactions(self, trytes):
+        with self._lock:
+            self._store(trytes)
+
+    def _store(self, trytes):
+        for tx_trytes in trytes:
+            tx = Transaction.from_tryte_string(tx_trytes)
+            if tx.hash in self.transactions:
+                continue
+            self.transactions[tx.hash] = TryteString(tx_trytes)
+            self.addresses.setdefault(str(tx.address), []).append(tx.hash)
+            self.tags.setdefault(str(tx.tag), []).append(tx.hash)
+            self.bundles.setdefault(str(tx.bundle_hash), []).append(tx.hash)
+            for approved in (str(tx.trunk_transaction_hash), str(tx.branch_transaction_hash)):
+                self._remove_tip(approved)
+            self._add_tip(tx.hash)
+
+    def _add_tip(self, tx_hash):
+        self._tip_positions[tx_hash] = len(self.tips)
+        self.tips.append(tx_hash)
+
+    def _remove_tip(self, tx_hash):
+        position = self._tip_positions.pop(tx_hash, None)
+        if position is None:
+            return
+        last = self.tips.pop()
+        if last != tx_hash:
+            self.tips[position] = last
+            self._tip_positions[last] = position
+
+    def send_trytes(self, trytes, depth=3, min_weight_magnitude=None):
+        """ Select tips, attach with proof of work and store the bundle. """
+        if self.min_weight_magnitude is not None:
+            min_weight_magnitude = self.min_weight_magnitude
+        elif min_weight_magnitude is None:
+            min_weight_magnitude = 9
+        tips = self.get_transactions_to_approve(depth)
+        attached = self.attach_to_tangle(tips['trunkTransaction'], tips['branchTransaction'],
+                                         trytes, min_weight_magnitude)
+        self.store_transactions(attached['trytes'])
+        return attached
+
+    def find_transactions(self, addresses=None, tags=None, bundles=None):
+        hashes = []
+        with self._lock:
+            for index, keys in ((self.addresses, addresses), (self.tags, tags), (self.bundles, bundles)):
+                for key in keys or []:
+                    hashes.extend(index.get(str(key), []))
+        return {'hashes': hashes}
+
+    def get_trytes(self, hashes):
+        with self._lock:
+            return {'trytes': [self.transactions.get(str(tx_hash), TryteString('9' * 2673))
+                               for tx_hash in hashes]}
+
+    def close(self):
+        if self._pow_pool is not None:
+            self._pow_pool.shutdown()
+            self._pow_pool = None
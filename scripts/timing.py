@@ -0,0 +1,195 @@
+# Timing - stage timers, counters and profiling of the simulation
+
+import cProfile
+import json
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import pandas as pd
+
+
+class StageTimer:
+    def __init__(self):
+        """ Wall time of every stage, recorded with perf_counter.
+
+        Records are (step, stage, seconds) tuples. step is the step being
+        run, None for the stages done before the step loop. The step is kept
+        per thread, so stages of different steps can run on different threads.
+        """
+        self.records = []
+        self._local = threading.local()
+
+    @property
+    def step(self):
+        return getattr(self._local, 'step', None)
+
+    @step.setter
+    def step(self, step):
+        self._local.step = step
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append((self.step, name, perf_counter() - start))
+
+    def begin_step(self, step):
+        self.step = step
+
+    def end_step(self):
+        self.step = None
+
+    def set_step(self, step):
+        """ Step of the stages and counters of this thread, without the
+        per step sampling of begin_step and end_step. For threads working
+        on steps begun by another one, None when done. """
+        self.step = step
+
+    def count(self, name, value=1):
+        """ Counters are only kept by a Trace. """
+
+    def __enter__(self):
+        global recorder
+        self._previous, recorder = recorder, self
+        return self
+
+    def __exit__(self, *exc):
+        global recorder
+        recorder = self._previous
+
+
+class Trace(StageTimer):
+    def __init__(self, memory=False, profile=None, top_allocations=5):
+        """ Stage timers plus hot path counters, memory and profiling per step.
+
+        While the trace is entered as a context manager it is the module
+        recorder, so the counters of blockchain.py and grid.py go to it.
+        Counters are added once per block or network, not per hash, so
+        a disabled trace only costs a no-op call at those points.
+
+        Args:
+            memory (bool): trace allocations with tracemalloc and record the
+                current and peak memory of every step
+            profile (str): file receiving a cProfile dump of the traced run,
+                no profiling if None
+            top_allocations (int): source lines with the most allocated memory
+                kept for every step when memory is traced
+        """
+        super().__init__()
+        self.memory = memory
+        self.profile = profile
+        self.top_allocations = top_allocations
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.allocations = {}
+        self._profiler = None
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[self.step][name] += value
+
+    def begin_step(self, step):
+        self.step = step
+        if self.memory:
+            tracemalloc.reset_peak()
+
+    def end_step(self):
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.count('memory_bytes', current)
+            self.count('peak_memory_bytes', peak)
+            statistics = tracemalloc.take_snapshot().statistics('lineno')[:self.top_allocations]
+            self.allocations[self.step] = [{'line': str(stat.traceback), 'bytes': stat.size}
+                                           for stat in statistics]
+        self.step = None
+
+    def __enter__(self):
+        super().__enter__()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile)
+            self._profiler = None
+        if self.memory:
+            tracemalloc.stop()
+        super().__exit__(*exc)
+
+    def rows(self):
+        """ One row per step with the seconds of every stage and the counters.
+
+        Stages and counters of the work done outside the step loop are in
+        the row of step None.
+        """
+        rows = defaultdict(lambda: defaultdict(float))
+        for step, stage, seconds in self.records:
+            rows[step][stage + '_seconds'] += seconds
+        for step, counters in self.counters.items():
+            rows[step].update(counters)
+        for row in rows.values():
+            if row.get('transactions') and row.get('mining_seconds'):
+                row['tx_per_second'] = row['transactions'] / row['mining_seconds']
+                row['mean_latency_seconds'] = row.get('latency_seconds', 0.0) / row['transactions']
+        steps = sorted(rows, key=lambda step: -1 if step is None else step)
+        return [dict(rows[step], step=step) for step in steps]
+
+    def to_frame(self):
+        frame = pd.DataFrame(self.rows())
+        frame['step'] = frame['step'].astype('Int64')
+        return frame[['step'] + [column for column in frame.columns if column != 'step']]
+
+    def save(self, path):
+        """ Write the per-step trace, as JSON if path ends in .json and CSV otherwise. """
+        if path.endswith('.json'):
+            steps = self.rows()
+            for row in steps:
+                if row['step'] in self.allocations:
+                    row['top_allocations'] = self.allocations[row['step']]
+            with open(path, 'w') as trace_file:
+                json.dump(steps, trace_file, indent=1)
+        else:
+            self.to_frame().to_csv(path, index=False)
+
+
+class NullTimer:
+    """ Timer recording nothing, used when no timer is given. """
+
+    def stage(self, name):
+        return nullcontext()
+
+    def begin_step(self, step):
+        pass
+
+    def end_step(self):
+        pass
+
+    def set_step(self, step):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    step = None
+
+
+null_timer = NullTimer()
+
+# Timer receiving the counters of the hot paths, replaced while a timer is entered
+recorder = null_timer
@@ -0,0 +1,184 @@
+# Topology - feeder layouts of the micro grid
+
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Lines between agent buses and the buses fed by a substation. Bus i is agent i.
+Topology = namedtuple('Topology', ['num_agents', 'from_bus', 'to_bus', 'length_km', 'substations'])
+
+# Layouts accepted by build_topology
+layouts = ('ring', 'radial', 'meshed', 'data')
+
+
+def ring(num_agents):
+    """ Every agent wired to the next one in a closed ring, with no substation. """
+    buses = np.arange(num_agents)
+    return Topology(num_agents, buses, np.roll(buses, -1), np.ones(num_agents), np.empty(0, dtype=int))
+
+
+def _feeder_nodes(num_agents, feeders):
+    return np.array_split(np.arange(num_agents), max(min(feeders, num_agents), 1))
+
+
+def radial(num_agents, feeders=1, seed=0, gen_nodes=None):
+    """ Tree shaped feeders, each one fed by a substation at its first bus
+    without a generator.
+
+    Agents are split into feeders of consecutive nodes and every agent is
+    wired to a random earlier agent of its feeder, the substation first. A
+    feeder made only of generator buses gets no substation, its generators
+    are its reference buses.
+
+    Args:
+        num_agents (int): number of agents
+        feeders (int): number of feeders
+        seed (int): seed of the wiring and the line lengths
+        gen_nodes (list): nodes of the agents that can supply power, kept
+            off the substations
+    """
+    random = np.random.RandomState(seed)
+    from_bus, to_bus, substations = [], [], []
+    for nodes in _feeder_nodes(num_agents, feeders):
+        loads = nodes[~np.isin(nodes, [] if gen_nodes is None else gen_nodes)]
+        if len(loads):
+            nodes = np.concatenate([loads[:1], nodes[nodes != loads[0]]])
+            substations.append(loads[0])
+        for position in range(1, len(nodes)):
+            from_bus.append(nodes[random.randint(position)])
+            to_bus.append(nodes[position])
+    length_km = random.uniform(0.2, 1.0, size=len(from_bus))
+    return Topology(num_agents, np.array(from_bus, dtype=int), np.array(to_bus, dtype=int), length_km,
+                    np.array(substations, dtype=int))
+
+
+def meshed(num_agents, clusters=1, ties=0.2, seed=0, gen_nodes=None):
+    """ Radial clusters with extra tie lines closing loops inside each cluster.
+
+    Args:
+        num_agents (int): number of agents
+        clusters (int): number of clusters, each one fed by a substation
+        ties (float): extra lines per agent of a cluster
+        seed (int): seed of the wiring and the line lengths
+        gen_nodes (list): nodes of the agents that can supply power, kept
+            off the substations
+    """
+    tree = radial(num_agents, clusters, seed, gen_nodes)
+    random = np.random.RandomState(seed + 1)
+    existing = set(zip(tree.from_bus.tolist(), tree.to_bus.tolist()))
+    from_bus, to_bus = [], []
+    for nodes in _feeder_nodes(num_agents, clusters):
+        if len(nodes) < 3:
+            continue
+        for _ in range(int(ties * len(nodes))):
+            first, second = sorted(random.choice(nodes, size=2, replace=False))
+            if (first, second) not in existing and (second, first) not in existing:
+                existing.add((first, second))
+                from_bus.append(first)
+                to_bus.append(second)
+    return Topology(num_agents, np.concatenate([tree.from_bus, np.array(from_bus, dtype=int)]),
+                    np.concatenate([tree.to_bus, np.array(to_bus, dtype=int)]),
+                    np.concatenate([tree.length_km, random.uniform(0.2, 1.0, size=len(from_bus))]),
+                    tree.substations)
+
+
+def load_topology(path, num_agents):
+    """ Topology of a data directory.
+
+    lines.csv holds from_bus, to_bus and length_km columns and the optional
+    substations.csv a node column. Nodes are agent positions, lines and
+    substations of agents past num_agents are left out.
+
+    Args:
+        path (str): data directory
+        num_agents (int): number of agents of the run
+    """
+    lines_path = os.path.join(path, 'lines.csv')
+    if not os.path.exists(lines_path):
+        raise FileNotFoundError("No lines.csv describing the topology in {}".format(path))
+    lines = pd.read_csv(lines_path)
+    lines = lines[(lines['from_bus'] < num_agents) & (lines['to_bus'] < num_agents)]
+    substations = np.empty(0, dtype=int)
+    substations_path = os.path.join(path, 'substations.csv')
+    if os.path.exists(substations_path):
+        substations = pd.read_csv(substations_path)['node'].values
+        substations = substations[substations < num_agents]
+    return Topology(num_agents, lines['from_bus'].values.astype(int), lines['to_bus'].values.astype(int),
+                    lines['length_km'].values.astype(float), substations.astype(int))
+
+
+def build_topology(layout, num_agents, feeders=1, seed=0, path=None, gen_nodes=None):
+    """ Topology by layout name.
+
+    Args:
+        layout (str): one of layouts, 'data' loads the one of path
+        num_agents (int): number of agents
+        feeders (int): feeders of 'radial' and clusters of 'meshed'
+        seed (int): seed of the wiring and the line lengths
+        path (str): data directory of the 'data' layout, see load_topology
+        gen_nodes (list): nodes of the agents that can supply power, kept
+            off the substations of 'radial' and 'meshed'
+    """
+    if layout == 'ring':
+        return ring(num_agents)
+    if layout == 'radial':
+        return radial(num_agents, feeders, seed, gen_nodes)
+    if layout == 'meshed':
+        return meshed(num_agents, feeders, seed=seed, gen_nodes=gen_nodes)
+    if layout == 'data':
+        if path is None:
+            raise ValueError("The data layout needs a data directory")
+        return load_topology(path, num_agents)
+    raise ValueError("Unknown layout {}, expected one of {}".format(layout, layouts))
+
+
+def partition(topology):
+    """ Electrically separate parts of the grid.
+
+    Feeders only meet at their substations, outside the modelled grid, so
+    the parts are the connected components of the line graph.
+
+    Returns:
+        parts (list): node array of every part, in order of its first node
+    """
+    n = topology.num_agents
+    graph = coo_matrix((np.ones(len(topology.from_bus)), (topology.from_bus, topology.to_bus)), shape=(n, n))
+    count, labels = connected_components(graph, directed=False)
+    order = np.argsort(labels, kind='stable')
+    parts = np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+    return sorted(parts, key=lambda nodes: nodes[0])
+
+
+def check_references(topology, parts, gen_nodes):
+    """ Raise if a part has neither a substation nor a generator, its power
+    flow would have no reference bus, or if a substation shares its bus
+    with a generator, whose output would then depend on how the slack is
+    split between them.
+
+    Args:
+        topology (Topology): lines and substations of the network
+        parts (list): node array of every part, see partition
+        gen_nodes (list): nodes of the agents that can supply power
+    """
+    shared = np.intersect1d(topology.substations, gen_nodes)
+    if len(shared):
+        raise ValueError("Substations on the generator buses {}, a feeder needs a bus "
+                         "without generation for its substation".format(shared.tolist()))
+    references = np.union1d(topology.substations, gen_nodes)
+    for nodes in parts:
+        if not np.isin(nodes, references).any():
+            raise ValueError("Buses {} have no substation or generator as reference bus".format(nodes.tolist()))
+
+
+def subtopology(topology, nodes):
+    """ Topology of the given nodes, renumbered in the order of nodes. """
+    local = np.full(topology.num_agents, -1)
+    local[nodes] = np.arange(len(nodes))
+    inside = (local[topology.from_bus] >= 0) & (local[topology.to_bus] >= 0)
+    substations = local[topology.substations]
+    return Topology(len(nodes), local[topology.from_bus[inside]], local[topology.to_bus[inside]],
+                    topology.length_km[inside], substations[substations >= 0])
@@ -0,0 +1,147 @@
+# Transactions - columnar storage of payment transactions
+
+import numpy as np
+
+
+class AddressBook:
+    def __init__(self):
+        """ Interned addresses, each one stored once and referenced by id. """
+        self.ids = {}
+        self.addresses = []
+
+    def intern(self, address):
+        address_id = self.ids.get(address)
+        if address_id is None:
+            address_id = len(self.addresses)
+            self.ids[address] = address_id
+            self.addresses.append(address)
+        return address_id
+
+    def intern_many(self, addresses):
+        return np.fromiter((self.intern(address) for address in addresses), dtype=np.int32)
+
+    def __getitem__(self, address_id):
+        return self.addresses[address_id]
+
+
+# Address book shared by the stores of this process
+address_book = AddressBook()
+
+
+class TransactionStore:
+    def __init__(self, capacity=1024, book=None):
+        """ Payment transactions kept as typed columns.
+
+        Authors and sellers are interned address ids, payments and
+        timestamps are float arrays. Columns grow by doubling, so appends are
+        amortized O(1). Transactions are read back as the dicts
+        Wrapper.new_transaction takes, for JSON outputs and hashing.
+
+        Args:
+            capacity (int): initial number of rows
+            book (AddressBook): address interning, the process one if None
+        """
+        self.book = address_book if book is None else book
+        self.size = 0
+        self.author = np.empty(capacity, dtype=np.int32)
+        self.seller = np.empty(capacity, dtype=np.int32)
+        self.payment = np.empty(capacity, dtype=np.float64)
+        self.timestamp = np.empty(capacity, dtype=np.float64)
+
+    @classmethod
+    def from_dicts(cls, transactions, book=None):
+        store = cls(max(len(transactions), 1), book)
+        for tx in transactions:
+            store.append_dict(tx)
+        return store
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("transaction index out of range")
+        return {'author': self.book[self.author[index]],
+                'content': {'payment': float(self.payment[index]),
+                            'seller': self.book[self.seller[index]]},
+                'timestamp': float(self.timestamp[index])}
+
+    def _reserve(self, extra):
+        needed = self.size + extra
+        capacity = len(self.payment)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity = max(2 * capacity, 1)
+        for column in ('author', 'seller', 'payment', 'timestamp'):
+            old = getattr(self, column)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, column, new)
+
+    def append(self, author, payment, seller, timestamp):
+        self._reserve(1)
+        index = self.size
+        self.author[index] = self.book.intern(author)
+        self.seller[index] = self.book.intern(seller)
+        self.payment[index] = payment
+        self.timestamp[index] = timestamp
+        self.size += 1
+
+    def append_dict(self, tx_data):
+        self.append(tx_data['author'], tx_data['content']['payment'],
+                    tx_data['content']['seller'], tx_data['timestamp'])
+
+    def extend(self, author, payments, sellers, timestamp):
+        """ Append the payments of one author in bulk.
+
+        Args:
+            author (str): address of the payer
+            payments (np.ndarray): amount of every payment
+            sellers (list): address of the seller of every payment
+            timestamp (float): submission time of the payments
+        """
+        count = len(payments)
+        self._reserve(count)
+        rows = slice(self.size, self.size + count)
+        self.author[rows] = self.book.intern(author)
+        self.seller[rows] = self.book.intern_many(sellers)
+        self.payment[rows] = payments
+        self.timestamp[rows] = timestamp
+        self.size += count
+
+    def extend_ids(self, authors, sellers, payments, timestamp):
+        """ Append payments of several authors with already interned addresses.
+
+        Args:
+            authors (np.ndarray): address id of the payer of every payment
+            sellers (np.ndarray): address id of the seller of every payment
+            payments (np.ndarray): amount of every payment
+            timestamp (float): submission time of the payments
+        """
+        count = len(payments)
+        self._reserve(count)
+        rows = slice(self.size, self.size + count)
+        self.author[rows] = authors
+        self.seller[rows] = sellers
+        self.payment[rows] = payments
+        self.timestamp[rows] = timestamp
+        self.size += count
+
+    def compact(self):
+        """ Release the unused capacity of the columns. """
+        for column in ('author', 'seller', 'payment', 'timestamp'):
+            setattr(self, column, getattr(self, column)[:self.size].copy())
+        return self
+
+    def to_list(self):
+        return list(self)
+
+    def nbytes(self):
+        return self.author.nbytes + self.seller.nbytes + self.payment.nbytes + self.timestamp.nbytes